@@ -10,7 +10,45 @@ import sys
 import qmmap
 
 
+def stats_main(argv):
+    par = argparse.ArgumentParser(prog="qmcli.py stats", description="""
+Report where the time went in a QMmap job, from the stats its workers recorded
+for each chunk.
+""")
+    par.add_argument("--dest_uri", default="mongodb://127.0.0.1/test", help=
+        "URI to the output DB, which holds the housekeeping collection"
+    )
+    par.add_argument("source_col", help="input/source collection of the job")
+    par.add_argument("dest_col", help="output/destination collection of the job")
+    clargs = par.parse_args(argv)
+    qmmap.job_stats(clargs.source_col, clargs.dest_col, clargs.dest_uri)
+
+
+def profile_main(argv):
+    par = argparse.ArgumentParser(prog="qmcli.py profile", description="""
+Merge the per-chunk profiles written by a QMmap job run with --profile into one
+report.
+""")
+    par.add_argument("--out", default=None, help=
+        "Also write the merged profile to this file"
+    )
+    par.add_argument("--sort", default="cumulative", help=
+        "Order of the report, as for pstats; default = cumulative"
+    )
+    par.add_argument("--limit", type=int, default=30, help=
+        "How many functions to list; default = 30"
+    )
+    par.add_argument("profile_dir", help="directory holding the .prof files")
+    clargs = par.parse_args(argv)
+    qmmap.merge_profiles(clargs.profile_dir, clargs.out, clargs.sort,
+        clargs.limit)
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "stats":
+        return stats_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "profile":
+        return profile_main(sys.argv[2:])
     par = argparse.ArgumentParser(description="""
 Command line wrapper for QMmap utility, which distributes the work of processing
 one collection into other by use of a function.
@@ -34,7 +72,8 @@ one collection into other by use of a function.
     )
     par.add_argument("--manage_only", action='store_true', help=
         "Only run the 'manage' stage of QMmap: report progress and reopen chunks" \
-        "being processed if they have taken longer than `timeout` seconds"
+        "being processed if their worker hasn't renewed its lease for " \
+        "`timeout` seconds"
     )
     par.add_argument("--source_uri", default="mongodb://127.0.0.1/test", help=
         "URI to the input DB, in MongoDB format:\n" \
@@ -50,13 +89,73 @@ one collection into other by use of a function.
         "of processes"
     )
     par.add_argument("--timeout", type=int, default=120, help=
-        "How long, in seconds, to allow a processor to work on a chunk before " \
-        "assuming it has died and should be released for other processes to work " \
-        "on it; default = 120 seconds"
+        "How long, in seconds, to allow a processor to go without renewing its " \
+        "lease on a chunk before assuming it has died and should be released " \
+        "for other processes to work on it; default = 120 seconds"
+    )
+    par.add_argument("--heartbeat", type=float, default=None, help=
+        "How often, in seconds, a processor renews its lease on the chunk it is " \
+        "working on; default = TIMEOUT / 4"
     )
     par.add_argument("--sleep", type=float, default=60, help=
         "Report status of the job every SLEEP seconds; default = 60"
     )
+    par.add_argument("--speculate", type=int, default=0, help=
+        "When no chunks are left to claim, let an idle processor start a " \
+        "backup copy of the longest-running chunk, with at most SPECULATE " \
+        "copies per chunk; the first copy to finish wins. Use with an upsert " \
+        "--write_mode, since every copy writes; default: 0 (off)"
+    )
+    par.add_argument("--speculate_after", type=float, default=60, help=
+        "Only start backup copies of chunks that have been working for at " \
+        "least this many seconds; default = 60"
+    )
+    par.add_argument("--checkpoint", action='store_true', help=
+        "Record a checkpoint in each chunk after every write, so that a chunk " \
+        "reopened after a failure carries on from there"
+    )
+    par.add_argument("--profile", type=float, default=0, help=
+        "Profile this fraction of chunks with cProfile, writing a .prof file " \
+        "per chunk to PROFILE_DIR; merge them with `qmcli.py profile`"
+    )
+    par.add_argument("--profile_dir", default=".", help=
+        "Directory to write chunk profiles to; default = current directory"
+    )
+    par.add_argument("--metrics_port", type=int, default=None, help=
+        "While managing the job, serve its metrics for Prometheus on this port"
+    )
+    par.add_argument("--metrics_log", default=None, help=
+        "While managing the job, append its metrics to this file as a line of " \
+        "JSON at each status update"
+    )
+    par.add_argument("--metrics_window", type=float, default=600, help=
+        "Seconds over which metric rates and ETA are averaged; default = 600"
+    )
+    par.add_argument("--metrics_host", default="127.0.0.1", help=
+        "Interface to serve metrics on; default = 127.0.0.1, so only this " \
+        "machine can scrape them; '' serves them on all interfaces"
+    )
+    par.add_argument("--fields", default=None, help=
+        "Comma-separated list of the source fields that `function` reads; " \
+        "only those (and the key and sort fields) are fetched"
+    )
+    par.add_argument("--raw", action='store_true', help=
+        "Pass `function` raw BSON documents, which only decode the fields it " \
+        "reads; it may return raw BSON too (needs pymongo 3.2 or later)"
+    )
+    par.add_argument("--claim", type=int, default=1, help=
+        "Claim this many chunks at a time, and mark them done together; " \
+        "default = 1"
+    )
+    par.add_argument("--split", action='store_true', help=
+        "When no chunks are left to claim, let an idle processor take over the " \
+        "unread upper half of a chunk another is working on; needs --sort to " \
+        "be the same as --key"
+    )
+    par.add_argument("--split_min", type=int, default=100, help=
+        "Only split chunks with at least this many entries left to read; " \
+        "default = 100"
+    )
     par.add_argument("--query", type=str, default="{}", help=
         "Query to restrict what values of the input collection to operate on; " \
         "default = {} (i.e. all of it)"
@@ -65,6 +164,14 @@ one collection into other by use of a function.
         "String indicating the function in `module` to run on each chunk before " \
         "processing it; default = None (no such function)"
     )
+    par.add_argument("--worker_init", type=str, default=None, help=
+        "String indicating the function in `module` to run once per run, " \
+        "before the worker processes are forked, to load data they share; " \
+        "what it returns is qmmap.worker_context; default = None"
+    )
+    par.add_argument("--worker_init_each", action="store_true", help=
+        "Run --worker_init once in each worker process instead"
+    )
     par.add_argument("--jsonconfig", type=str, default=None, help=
         "Path to JSON file for specifying this utility's parameters; overrides " \
         "any which were specified from the command line"
@@ -85,6 +192,83 @@ one collection into other by use of a function.
         "`sort` key (put a '-' in front to sort descending e.g. '-name'); " \
         "default: _id"
     )
+    par.add_argument("--incremental", action='store_true', help=
+        "Keep the housekeeping chunks of earlier runs and only add (and " \
+        "process) chunks for documents whose `key` is past the last chunk's end;" \
+        " for append-only inputs"
+    )
+    par.add_argument("--follow", action='store_true', help=
+        "Instead of a one-off run, keep running `function` on documents as " \
+        "they are inserted into or updated in the input collection (needs a " \
+        "replica set); restarting picks up where the last run stopped"
+    )
+    par.add_argument("--partition", type=str, default="exact",
+        choices=["exact", "range", "sample"], help=
+        "How to set up the housekeeping chunks: 'exact' scans every key once " \
+        "and gives exact chunk totals; 'range' computes chunk boundaries from " \
+        "the min and max key (ObjectId, date or numeric keys only) without a " \
+        "scan; 'sample' takes split points from a random sample of keys; " \
+        "default: exact"
+    )
+    par.add_argument("--sample_size", type=int, default=10000, help=
+        "Number of keys to sample with --partition=sample; default: 10000"
+    )
+    par.add_argument("--rebalance", type=float, default=None, help=
+        "With --partition=range or sample, split a claimed chunk in half whenever it " \
+        "holds more than REBALANCE times its estimated size; default: off"
+    )
+    par.add_argument("--batch", type=int, default=None, help=
+        "Call `function` on lists of BATCH documents instead of one at a time; " \
+        "it must return a list with one output (or None) per input. A batch " \
+        "that fails is retried one document at a time; default: off"
+    )
+    par.add_argument("--write_queue", type=int, default=0, help=
+        "Execute bulk writes on a background thread while processing goes on, " \
+        "with at most WRITE_QUEUE bulk writes waiting; default: 0 (write " \
+        "synchronously)"
+    )
+    par.add_argument("--prefetch", type=int, default=0, help=
+        "Read input documents on a background thread, keeping up to PREFETCH " \
+        "batches ready ahead of processing; default: 0 (off)"
+    )
+    par.add_argument("--write_bytes", type=int, default=qmmap.WRITE_THRESHOLD,
+        help=
+        "Write buffered output documents once they total WRITE_BYTES bytes; " \
+        "default: %d" % qmmap.WRITE_THRESHOLD
+    )
+    par.add_argument("--write_count", type=int, default=None, help=
+        "Also write buffered output documents once there are WRITE_COUNT of " \
+        "them; default: no count limit"
+    )
+    par.add_argument("--write_mode", type=str, default="auto",
+        choices=qmmap.WRITE_MODES, help=
+        "How to write output documents that have an _id: 'insert' (fastest " \
+        "when the output starts empty, e.g. with --reset), 'replace' the " \
+        "whole document, 'set' its fields or 'inc' its fields by the output's " \
+        "values, upserting in the last three cases; default: auto ('set' " \
+        "with --multi, else 'replace')"
+    )
+    par.add_argument("--w", type=str, default=None, help=
+        "Write concern 'w' for output writes, e.g. 0, 1 or majority; default: " \
+        "the server's"
+    )
+    par.add_argument("--j", action="store_const", const=True, default=None,
+        help="Require output writes to be journaled"
+    )
+    par.add_argument("--ordered", action="store_true", help=
+        "Execute the output writes of a bulk op in order, stopping at the " \
+        "first error; default is unordered"
+    )
+    par.add_argument("--threads", type=int, default=None, help=
+        "Within each process, run `function` on a pool of THREADS threads; " \
+        "useful when it mostly waits on I/O. Output keeps the `sort` order; " \
+        "default: off"
+    )
+    par.add_argument("--inflight", type=int, default=None, help=
+        "Allow `function` and `init` to return futures (objects with a " \
+        "blocking result() method), keeping up to INFLIGHT outputs pending " \
+        "at once; default: off"
+    )
     par.add_argument("module", help=
         "Python module containing the function you wish to apply to the input " \
         "collection, e.g. foo.bar[...]"
@@ -122,12 +306,21 @@ one collection into other by use of a function.
     if clargs.init:
         init_fn = getattr(module, clargs.init)
         arg_dict['init'] = init_fn
+    if clargs.worker_init:
+        arg_dict['worker_init'] = getattr(module, clargs.worker_init)
     # Remove the parsed params that aren't handled by qmmap.mmap
     del arg_dict['module']
     del arg_dict['pyconfig']
     del arg_dict['jsonconfig']
     # Convert query to python dict
     arg_dict['query'] = loads(arg_dict['query'])
+    # Fields from a config file may already be a list
+    if arg_dict['fields'] and isinstance(arg_dict['fields'], basestring):
+        arg_dict['fields'] = arg_dict['fields'].split(",")
+    # Write concern w is a number of nodes unless it names a mode; from a config
+    # file, it may already be a number
+    if isinstance(arg_dict['w'], basestring) and arg_dict['w'].isdigit():
+        arg_dict['w'] = int(arg_dict['w'])
     qmmap.mmap(**arg_dict)
 
 
@@ -2,17 +2,41 @@
 # mongo Operations
 #
 import sys, os, importlib, datetime, time, traceback, __main__
-import socket
+import socket, math, bisect, threading, Queue, collections
+import random, re, glob, cProfile, pstats, json, BaseHTTPServer, struct
 
 import bson
+from bson.min_key import MinKey
+from bson.max_key import MaxKey
 import pymongo
 from pymongo.read_preferences import ReadPreference
+try:
+    from bson.raw_bson import RawBSONDocument
+    from bson.codec_options import CodecOptions
+except ImportError:  # pymongo before 3.2
+    RawBSONDocument = CodecOptions = None
 from multiprocessing import Process
+from multiprocessing.pool import ThreadPool
 import mongoengine as meng
 from mongoengine.context_managers import switch_collection
+from mongoengine.base import get_document
 
 NULL = open(os.devnull, "w")
 BATCH_SIZE = 600  # Set input batch size; mongo will limit it if it's too much
+KEY_BATCH_SIZE = 10000  # Batch size for key-only scans when partitioning
+HK_BATCH_SIZE = 1000  # Housekeeping records written per bulk insert
+# Measure the size of every this-many'th document read, and of those written
+# when they can't be sent already encoded
+STATS_SAMPLE = 100
+# After you've accumulated this many bytes of objects, execute the bulk write
+# and start it over
+WRITE_THRESHOLD = 10000000
+# How output documents are written; 'auto' is $set with housekeeping, and
+# replace (like `save`) without it
+WRITE_MODES = ('auto', 'insert', 'replace', 'set', 'inc')
+# Error codes of servers that can't open a change stream at all: a standalone
+# server, and an unrecognized $changeStream stage (before 3.6)
+NO_CHANGE_STREAMS = (40573, 40324, 16436)
 
 def is_shell():
     return sys.argv[0] == "" or sys.argv[0][-8:] == "/ipython"
@@ -28,9 +52,32 @@ class housekeep(meng.Document):
     # Globally unique identifier for the process, if any, that is working on
     # this chunk, to know if something else is working on it
     procname = meng.StringField(default = 'none')
+    # Processes running backup copies of this chunk, when it's straggling
+    backups = meng.ListField(meng.StringField())
 #     git = meng.StringField()                                 # git commit of this version of source_destination
     tstart = meng.DateTimeField()  # Time when job started
     time = meng.DateTimeField()  # Time when job finished
+    # Last time the working process renewed its lease on the chunk, and how
+    # many entries it had read by then
+    heartbeat = meng.DateTimeField()
+    progress = meng.IntField(default = 0)
+    # For chunks processed in `key` order: the last key read, as of the last
+    # heartbeat, and a key at which an idle process has asked for the rest of
+    # the chunk (`split_total` entries) to be split off
+    position = meng.DynamicField()
+    split_at = meng.DynamicField()
+    split_total = meng.IntField()
+    # Last `sort` value all of whose entries have been written, with the 'good'
+    # and 'seen' counts as of then, for the chunk to be resumed from
+    checkpoint = meng.DictField()
+    # How the chunk's worker spent its time, the bytes read and written, and
+    # its throughput (see `_process`)
+    stats = meng.DictField()
+    # Chunk covers [start, end) instead of [start, end]; used by partitioners
+    # that compute boundaries rather than read them from the data
+    end_exclusive = meng.BooleanField(default = False)
+    # `total` is an estimate, to be replaced by the real count when done
+    estimated = meng.BooleanField(default = False)
     meta = {'indexes': ['state', 'time']}
 
 def _connect(srccol, destcol, dest_uri=None):
@@ -38,47 +85,385 @@ def _connect(srccol, destcol, dest_uri=None):
     hk_colname = srccol.name + '_' + destcol.name
     switch_collection(housekeep, hk_colname).__enter__()
 
-def _init(srccol, destcol, key, query, chunk_size, verbose):
-    housekeep.drop_collection()
+def _init(srccol, destcol, key, query, chunk_size, verbose, drop=True):
+    """Set up the housekeeping collection in a single sorted pass over `key`.
+Chunk boundaries and exact totals are emitted as the scan streams by; a chunk
+is only closed where the key value changes, so documents sharing a `key` value
+always land in the same chunk.
+    @drop: start from an empty housekeeping collection; otherwise add chunks to
+the existing ones (see `_incremental_query`)
+    """
+    if drop:
+        housekeep.drop_collection()
     q = srccol.find(query, [key]).sort([(key, pymongo.ASCENDING)])
-    if verbose & 2: print "initializing %d entries, housekeeping for %s" % (q.count(), housekeep._get_collection_name())
-#     else:
-#         raise Exception("no incremental yet")
-# #         last = housekeep.objects().order_by('-start')[0].end
-# #         if verbose & 2: print "last partition field in housekeep:", last
-# #         query[key + "__gt"] = last
-# #         q = srccol.objects(**query).only(key).order_by(key)
-# #         if verbose & 2: print "added %d entries to %s" % (q.count(), housekeep._get_collection_name())
-# #         sys.stdout.flush()
+    q.batch_size(KEY_BATCH_SIZE)
+    if verbose & 2: print "initializing housekeeping for %s" % housekeep._get_collection_name()
     i = 0
-    tot = q.limit(chunk_size).count(with_limit_and_skip=True)
-    while tot > 0:
+    records = []
+    start = end = None
+    tot = 0
+    for doc in q:
+        val = doc.get(key)
+        if val == None:
+            if verbose & 2: print >> sys.stderr, "ERROR: key field has None. start: %s end: %s" % (start, val)
+            raise Exception("key error")
+        # Only cut on a change of key value, so equal keys stay together
+        if tot >= chunk_size and val != end:
+            if verbose & 2: print "housekeeping: %d" % i
+            i += 1
+            records.append(housekeep(start=start, end=end, total=tot).to_mongo())
+            if len(records) >= HK_BATCH_SIZE:
+                _insert_housekeep(records)
+                records = []
+            tot = 0
+        if tot == 0:
+            start = val
+        end = val
+        tot += 1
+    if tot > 0:
         if verbose & 2: print "housekeeping: %d" % i
-        i +=1
+        records.append(housekeep(start=start, end=end, total=tot).to_mongo())
+    if records:
+        _insert_housekeep(records)
+    sys.stdout.flush()
+
+
+def _init_range(srccol, destcol, key, query, chunk_size, count, verbose,
+        drop=True):
+    """Set up the housekeeping collection by arithmetic on the key range, without
+reading every key: only the min and max of `key` are fetched, and the span
+between them is cut into evenly spaced [start, end) ranges. Works for ObjectId,
+datetime and numeric keys; totals are estimates until each chunk finishes.
+    @drop: as for `_init`
+    """
+    if drop:
+        housekeep.drop_collection()
+    lo = srccol.find_one(query, [key], sort=[(key, pymongo.ASCENDING)])
+    if lo == None:
+        if verbose & 2: print "nothing to partition in %s" % srccol.name
+        return
+    hi = srccol.find_one(query, [key], sort=[(key, pymongo.DESCENDING)])
+    lo, hi = lo.get(key), hi.get(key)
+    if (lo == None or hi == None):
+        if verbose & 2: print >> sys.stderr, "ERROR: key field has None. start: %s end: %s" % (lo, hi)
+        raise Exception("key error")
+    num_chunks = max(1, int(math.ceil(count / float(chunk_size))))
+    bounds = [lo] + _range_points(lo, hi, num_chunks) + [hi]
+    if lo == hi:
+        bounds = [lo, hi]
+    est = int(math.ceil(count / float(len(bounds) - 1)))
+    if verbose & 2: print "initializing %d ranges, housekeeping for %s" % (len(bounds) - 1, housekeep._get_collection_name())
+    records = []
+    for i in xrange(len(bounds) - 1):
+        last = i == len(bounds) - 2
+        records.append(housekeep(start=bounds[i], end=bounds[i+1],
+            end_exclusive=not last, total=est, estimated=True).to_mongo())
+        if len(records) >= HK_BATCH_SIZE:
+            _insert_housekeep(records)
+            records = []
+    if records:
+        _insert_housekeep(records)
+    sys.stdout.flush()
+
+
+def _init_sample(srccol, destcol, key, query, chunk_size, count, sample_size,
+        verbose):
+    """Set up the housekeeping collection from a sample of the keys, in time bounded
+by `sample_size` rather than by the collection size. Split points are quantiles
+of the sample; the first chunk starts at MinKey and the last ends at MaxKey, so
+every document is covered. Totals are estimates until each chunk finishes.
+    """
+    housekeep.drop_collection()
+    keys = sorted(_sample_keys(srccol, key, query, count, sample_size))
+    if not keys:
+        if verbose & 2: print "nothing to partition in %s" % srccol.name
+        return
+    num_chunks = max(1, int(math.ceil(count / float(chunk_size))))
+    bounds = [MinKey()]
+    for i in xrange(1, num_chunks):
+        p = keys[len(keys) * i // num_chunks]
+        # Equal keys can't straddle a boundary, so skip repeated split points
+        if len(bounds) == 1 or p > bounds[-1]:
+            bounds.append(p)
+    bounds.append(MaxKey())
+    if verbose & 2: print "initializing %d chunks from %d sampled keys, housekeeping for %s" % (len(bounds) - 1, len(keys), housekeep._get_collection_name())
+    records = []
+    lo = 0
+    for i in xrange(len(bounds) - 1):
+        last = i == len(bounds) - 2
+        hi = len(keys) if last else bisect.bisect_left(keys, bounds[i+1])
+        est = int(round(count * (hi - lo) / float(len(keys))))
+        records.append(housekeep(start=bounds[i], end=bounds[i+1],
+            end_exclusive=not last, total=est, estimated=True).to_mongo())
+        if len(records) >= HK_BATCH_SIZE:
+            _insert_housekeep(records)
+            records = []
+        lo = hi
+    if records:
+        _insert_housekeep(records)
+    sys.stdout.flush()
+
+
+def _sample_keys(srccol, key, query, count, sample_size):
+    """Returns up to `sample_size` values of `key` drawn with $sample, falling back
+to a strided key scan on servers without $sample (before 3.2). Documents without
+the key are skipped; they sort first and so land in the first chunk.
+    """
+    pipeline = [{'$sample': {'size': sample_size}}, {'$project': {key: 1}}]
+    if query:
+        pipeline.insert(0, {'$match': query})
+    try:
+        docs = _aggregate(srccol, pipeline)
+    except pymongo.errors.OperationFailure:
+        stride = max(1, count // sample_size)
+        q = srccol.find(query, [key]).sort([(key, pymongo.ASCENDING)])
+        q.batch_size(KEY_BATCH_SIZE)
+        docs = (doc for i, doc in enumerate(q) if i % stride == 0)
+    return [doc[key] for doc in docs if doc.get(key) != None]
+
+
+def _aggregate(col, pipeline):
+    """Returns the list of documents produced by aggregation `pipeline` on
+collection `col`, for either pymongo version
+    """
+    if pymongo.version_tuple[0] == 2:
+        return col.aggregate(pipeline)['result']
+    return list(col.aggregate(pipeline))
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _key_to_num(val):
+    """Map a key value onto a number that can be interpolated, so chunk boundaries
+can be computed instead of read; raises ValueError for unsupported types
+    """
+    if isinstance(val, bson.ObjectId):
+        return long(str(val), 16)
+    if isinstance(val, datetime.datetime):
+        if val.utcoffset() != None:
+            val = val.replace(tzinfo=None) - val.utcoffset()
+        delta = val - _EPOCH
+        # BSON dates have millisecond resolution
+        return (delta.days * 86400 + delta.seconds) * 1000 + \
+            delta.microseconds // 1000
+    if isinstance(val, (int, long, float)) and not isinstance(val, bool):
+        return val
+    raise ValueError("Can't compute chunk boundaries for key value %r" % (val,))
+
+
+def _num_to_key(num, like):
+    """Inverse of `_key_to_num`, returning a value of the same type as `like`
+    """
+    if isinstance(like, bson.ObjectId):
+        return bson.ObjectId("%024x" % num)
+    if isinstance(like, datetime.datetime):
+        return _EPOCH + datetime.timedelta(milliseconds=num)
+    return type(like)(num)
+
+
+def _range_points(lo, hi, n):
+    """Returns the (at most n-1) distinct values strictly between `lo` and `hi`
+that cut the range into n roughly equal parts
+    """
+    lo_num, hi_num = _key_to_num(lo), _key_to_num(hi)
+    points = []
+    for i in xrange(1, n):
+        p = _num_to_key(lo_num + (hi_num - lo_num) * i / n, lo)
+        if p > lo and p < hi and (not points or p > points[-1]):
+            points.append(p)
+    return points
+
+
+def _chunk_query(query, key, start, end, end_exclusive=False):
+    """Returns the query for the documents of the chunk [start, end] (or [start,
+end) if `end_exclusive`), restricted by `query`
+    """
+    return {'$and': [query, {key: {'$gte': start}},
+        {key: {'$lt' if end_exclusive else '$lte': end}}]}
+
+
+def _rebalance(src_col, query, key, hko, rebalance, verbose):
+    """Lazily split a claimed chunk whose estimated total was too low: while it
+holds more than `rebalance` times its estimate, give its upper half back to the
+housekeeping collection as a new open chunk. Empty chunks need no help; they
+finish immediately and get a total of 0.
+    """
+    limit = int(max(hko.total, 1) * rebalance) + 1
+    while True:
+        qq = _chunk_query(query, key, hko.start, hko.end, hko.end_exclusive)
+        if src_col.find(qq).limit(limit).count(with_limit_and_skip=True) < limit:
+            return
+        try:
+            mid = _range_points(hko.start, hko.end, 2)
+        except ValueError:  # key type has no arithmetic; can't split
+            return
+        if not mid:
+            return
+        mid = mid[0]
+        if verbose & 2: print "splitting oversized chunk %s-%s at %s" % (hko.start, hko.end, mid)
+        try:
+            _insert_housekeep([housekeep(start=mid, end=hko.end,
+                end_exclusive=hko.end_exclusive, total=hko.total,
+                estimated=True).to_mongo()])
+        except pymongo.errors.BulkWriteError:
+            # A chunk already starts there, e.g. from a split by an earlier
+            # worker on this chunk that died before shrinking it
+            print "Can't split chunk {0} at {1}; a chunk starts there".format(
+                hko.start, mid)
+            sys.stdout.flush()
+            return
+        # Only shrink the chunk while it is still ours; otherwise take back
+        # the half given up, and let the lease renewal report the loss
+        if not _update_one(housekeep._collection, {'_id': hko.start,
+                'state': 'working', 'procname': procname()},
+                {'$set': {'end': mid, 'end_exclusive': True}}):
+            housekeep._collection.remove({'_id': mid, 'state': 'open'})
+            return
+        hko.end = mid
+        hko.end_exclusive = True
+
+
+def _incremental_query(query, key, verbose):
+    """Returns `query` restricted to documents whose `key` is past the end of the
+last housekeeping chunk (the high-water mark of earlier runs), or `query` as is
+if there are no chunks yet
+    """
+    last = housekeep.objects().order_by('-start').only('end', 'end_exclusive').first()
+    if last == None:
+        return query
+    if verbose & 2: print "last partition field in housekeep:", last.end
+    op = '$gte' if last.end_exclusive else '$gt'
+    return {'$and': [query, {key: {op: last.end}}]}
+
+
+def _insert_housekeep(records):
+    """Write a list of housekeeping records (already in Mongo format) with one
+bulk insert
+    """
+    bulk = housekeep._get_collection().initialize_unordered_bulk_op()
+    for rec in records:
+        bulk.insert(rec)
+    bulk.execute()
+
+
+def _renew_lease(hkstart, progress=0, position=None, limits=None):
+    """Renews this process's lease on a chunk, identified by its housekeeping start
+value, recording `progress` (entries read so far). Returns whether the chunk is
+still okay to work on, i.e. the renewal found it "working" and assigned to this
+process, either as its worker or as a backup; that costs one update (two for a
+backup, which doesn't record progress), and only a failed renewal reads the
+chunk back to report why.
+    @position, limits: for a chunk being read in `key` order, the last key read,
+to publish, and a dict to which any split of the chunk is applied (see
+`_accept_split`)
+    """
+    if hkstart == None:  # Can ignore if specific chunk not specified
+        return True
+    tnow = datetime.datetime.utcnow()
+    if limits != None:
+        if housekeep.objects(start=hkstart, state='working',
+                procname=procname(), split_at=None).update(
+                set__heartbeat=tnow, set__progress=progress,
+                set__position=position):
+            return True
+        # Either lost, or another process wants to split the chunk
+        return _accept_split(hkstart, progress, position, limits)
+    if housekeep.objects(start=hkstart, state='working',
+            procname=procname()).update(
+            set__heartbeat=tnow, set__progress=progress):
+        return True
+    if housekeep.objects(start=hkstart, state='working',
+            backups=procname()).update(set__heartbeat=tnow):
+        return True
+    _is_okay_to_work_on(hkstart)
+    return False
+
+
+def _save_checkpoint(hkstart, mark, writer):
+    """Records checkpoint `mark` on chunk `hkstart`, once everything before it has
+been written by `writer`, provided this process is still the chunk's worker.
+Writes that failed so far are taken off its 'good' count.
+    """
+    mark = dict(mark, good=mark['good'] - writer.failed)
+    housekeep.objects(start=hkstart, state='working',
+        procname=procname()).update(set__checkpoint=mark)
+
+
+def _accept_split(hkstart, progress, position, limits):
+    """Answers a request to split chunk `hkstart` at key `split_at`. If this process
+hasn't read that far yet (the last key read being `position`), the keys from
+`split_at` on become a new open chunk, and `limits` gets the chunk's new end in
+'end' and 'end_exclusive'; otherwise the request is dropped. Since the split
+point is a key value, entries with equal keys stay in the same chunk.
+    @return: whether the chunk is still okay to work on
+    """
+    me = procname()
+    chunk = housekeep._collection.find_one({'_id': hkstart})
+    if chunk == None or chunk['state'] != 'working' or chunk['procname'] != me:
+        _is_okay_to_work_on(hkstart)
+        return False
+    cond = {'_id': hkstart, 'state': 'working', 'procname': me}
+    update = {'heartbeat': datetime.datetime.utcnow(), 'progress': progress,
+        'position': position, 'split_at': None}
+    split_at = chunk.get('split_at')
+    if split_at != None and position != None and position < split_at:
+        split_total = chunk.get('split_total') or 0
+        # Add the new chunk before shrinking this one, so that no entries are
+        # left without a chunk if we die in between
+        try:
+            _insert_housekeep([housekeep(start=split_at, end=chunk['end'],
+                end_exclusive=chunk.get('end_exclusive', False),
+                total=split_total, estimated=True).to_mongo()])
+        except pymongo.errors.BulkWriteError:
+            # A chunk already starts there, e.g. from an earlier split that
+            # was rolled back; drop the request and carry on
+            print "Can't split chunk {0} at {1}; a chunk starts there".format(
+                hkstart, split_at)
+            sys.stdout.flush()
+            return bool(_update_one(housekeep._collection, cond,
+                {'$set': update}))
+        # Both totals are now estimates, to be counted as the chunks finish
+        update.update({'end': split_at, 'end_exclusive': True,
+            'total': max(0, (chunk.get('total') or 0) - split_total),
+            'estimated': True})
+        if not _update_one(housekeep._collection, cond, {'$set': update}):
+            housekeep._collection.remove({'_id': split_at, 'state': 'open'})
+            _is_okay_to_work_on(hkstart)
+            return False
+        limits['end'] = split_at
+        limits['end_exclusive'] = True
+        print "Split chunk {0} at {1}, giving up {2} entries".format(hkstart,
+            split_at, split_total)
         sys.stdout.flush()
-        hk = housekeep()
-        hk.start = q[0][key]
-        hk.end =  q[min(chunk_size-1, tot-1)][key]
-        if (hk.start == None or hk.end == None):
-            if verbose & 2: print >> sys.stderr, "ERROR: key field has None. start: %s end: %s" % (hk.start, hk.end)
-            raise Exception("key error")
-        #calc total for this segment
-        qq = {'$and': [query, {key: {'$gte': hk.start}}, {key: {'$lte': hk.end}}]}
-        hk.total = srccol.find(qq, [key]).count()
-        hk.save()
+        return True
+    return bool(_update_one(housekeep._collection, cond, {'$set': update}))
 
-        #get start of next segment
-        qq = {'$and': [query, {key: {'$gt': hk.end}}]}
-        q = srccol.find(qq, [key]).sort([(key, pymongo.ASCENDING)])
-        #limit count to chunk for speed
-        tot = q.limit(chunk_size).count(with_limit_and_skip=True)
+
+def _update_one(col, spec, update):
+    """Updates the first document of `col` matching `spec`, for either pymongo
+version
+    @return: number of documents matched (0 or 1)
+    """
+    if pymongo.version_tuple[0] == 2:
+        return col.update(spec, update)['n']
+    return col.update_one(spec, update).matched_count
+
+
+def _update_many(col, spec, update):
+    """Updates all documents of `col` matching `spec`, for either pymongo version
+    @return: number of documents matched
+    """
+    if pymongo.version_tuple[0] == 2:
+        return col.update(spec, update, multi=True)['n']
+    return col.update_many(spec, update).matched_count
 
 
 def _is_okay_to_work_on(hkstart):
     """Returns whether a chunk, identified by its housekeeping start value, is okay
 to work on, i.e. whether its status is "working" and this process is assigned to it
     """
-    if not hkstart:  # Can ignore if specific chunk not specified
+    if hkstart == None:  # Can ignore if specific chunk not specified
         return True
     chunk = housekeep.objects.get(start=hkstart)
     # If it's been reset to open, or being worked on by another node, no good
@@ -91,7 +476,8 @@ to work on, i.e. whether its status is "working" and this process is assigned to
         print "Chunk {0} had been reset to open".format(hkstart)
         sys.stdout.flush()
         return False
-    if state == "working" and chunk.procname != procname():
+    if state == "working" and chunk.procname != procname() and \
+            procname() not in chunk.backups:
         print "Chunk {0} was taken over by {1}, moving on".format(
             hkstart, chunk.procname)
         sys.stdout.flush()
@@ -101,11 +487,61 @@ to work on, i.e. whether its status is "working" and this process is assigned to
 
 def _doc_size(doc):
     """Returns the size, in bytes of a Mongo object
-    @doc: Mongo document in native Mongo format
+    @doc: Mongo document in native Mongo format, or a RawBSONDocument
     """
+    if RawBSONDocument and isinstance(doc, RawBSONDocument):
+        return len(doc.raw)
     return len(bson.BSON.encode(doc))
 
 
+# Sizes of the fixed-size BSON types an _id is usually of: double, ObjectId,
+# date, int32 and int64
+_ID_SIZES = {'\x01': 8, '\x07': 12, '\x09': 8, '\x10': 4, '\x12': 8}
+
+
+def _raw_id(doc):
+    """Returns (whether RawBSONDocument `doc` has an _id, the _id); when the _id
+is the first field, as it usually is, it is read straight from the bytes,
+without decoding the rest of the document
+    """
+    raw = doc.raw
+    if raw[5:9] == '_id\x00':
+        size = _ID_SIZES.get(raw[4])
+        if raw[4] == '\x02':  # string: length, then the bytes
+            size = 4 + struct.unpack('<i', raw[9:13])[0]
+        if size:
+            elem = raw[4:9 + size]
+            return True, bson.BSON(struct.pack('<i', len(elem) + 5) + elem +
+                '\x00').decode()['_id']
+    if '_id' in doc:
+        return True, doc['_id']
+    return False, None
+
+
+def _projection(fields, *needed):
+    """Returns the projection for reading only `fields` of the source documents,
+plus any fields in `needed` that processing relies on, such as the key and sort
+fields; None, for whole documents, if `fields` is None
+    """
+    if fields == None:
+        return None
+    fields = list(fields)
+    for field in needed:
+        if field and field not in fields:
+            fields.append(field)
+    return fields
+
+
+def _raw_collection(col):
+    """Returns collection `col` set to return documents as RawBSONDocuments, which
+only decode the fields that are accessed
+    """
+    if RawBSONDocument == None:
+        raise Exception("Raw mode needs pymongo 3.2 or later")
+    return col.with_options(
+        codec_options=CodecOptions(document_class=RawBSONDocument))
+
+
 def _copy_cursor(cursor):
     """Returns a new cursor with the same properites that won't affect the original
     @cursor: any cursor that hasn't already been iterated over
@@ -117,21 +553,534 @@ def _copy_cursor(cursor):
     return new_cursor
 
 
-def _write_bulk(bulk):
-    """Execute bulk write `bulk` and note the errors
+def _write_bulk(bulk, count, write_concern=None):
+    """Execute bulk write `bulk` of `count` operations and note the errors
+    @write_concern: optional dict of write concern options, e.g. {'w': 1}
+    @return: number of operations that failed
     """
     try:
-        bulk.execute()
+        bulk.execute(write_concern)
+        return 0
+    except pymongo.errors.BulkWriteError as e:
+        _print_proc("***BULK WRITE EXCEPTION (process)***")
+        _print_proc(traceback.format_exc())
+        _print_proc("***END EXCEPTION***")
+        # An ordered bulk op stops at the first error, so count everything
+        # that wasn't applied rather than just the reported errors
+        return count - (e.details.get('nInserted', 0) +
+            e.details.get('nUpserted', 0) + e.details.get('nMatched', 0))
     except:
         _print_proc("***BULK WRITE EXCEPTION (process)***")
         _print_proc(traceback.format_exc())
         _print_proc("***END EXCEPTION***")
+        return count
+
+
+class _BulkWriter(object):
+    """Buffers output documents into bulk ops on collection `dest`, to be written
+once they pass `max_bytes` bytes or `max_count` documents, with write concern
+`write_concern` (a dict) and unordered unless `ordered`.
+    @mode: how to write a document, one of
+        'insert': always insert (fastest, when the destination starts empty)
+        'replace': upsert by _id, replacing the whole document (like `save`)
+        'set': upsert by _id, $set'ing the document's fields
+        'inc': upsert by _id, $inc'ing the existing fields by the document's
+    Documents without an _id are always inserted.
+Where the driver can send pre-encoded documents (pymongo 3.2 or later), each
+one is encoded just once, as it is added, which also gives its size; otherwise,
+and for 'replace' and 'inc', sizes are estimated from a sample of the documents.
+(The driver's checks on a replacement decode a pre-encoded one in full, so
+encoding it first would only add work.)
+With `queue_depth`, bulk ops are executed on a background thread so processing
+can go on filling the next one; once `queue_depth` ops are waiting to be
+written, `flush` blocks until the thread catches up.
+    """
+    def __init__(self, dest, max_bytes=WRITE_THRESHOLD, max_count=None,
+            queue_depth=0, mode='set', write_concern=None, ordered=False):
+        self.dest = dest
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.mode = mode
+        self.write_concern = write_concern
+        self.ordered = ordered
+        self.failed = 0  # Number of writes that failed
+        self.t_write = 0.0  # Seconds spent executing bulk ops
+        self.written = 0  # Bytes of documents sent to be written
+        self.added = 0  # Documents added in all
+        self.sampled = self.sampled_bytes = 0  # Documents measured, and size
+        self.queue = None
+        if queue_depth:
+            self.queue = Queue.Queue(maxsize=queue_depth)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self._new_bulk()
+
+    def _new_bulk(self):
+        if self.ordered:
+            self.bulk = self.dest.initialize_ordered_bulk_op()
+        else:
+            self.bulk = self.dest.initialize_unordered_bulk_op()
+        self.size = 0  # Size, in bytes, of all objects to be written
+        self.count = 0  # Number of writes
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                return
+            bulk, count, done = item
+            t = time.time()
+            self.failed += _write_bulk(bulk, count, self.write_concern)
+            self.t_write += time.time() - t
+            if done:
+                done()
+
+    def add(self, ret):
+        """Add output document `ret` to the bulk op; it may also be a
+RawBSONDocument, or a string of BSON
+        @return: whether the bulk op is now past one of the thresholds
+        """
+        if isinstance(ret, str):
+            ret = RawBSONDocument(ret)
+        if self.mode == 'insert':
+            has_id, _id = False, None  # inserted either way
+        elif RawBSONDocument != None and isinstance(ret, RawBSONDocument):
+            has_id, _id = _raw_id(ret)
+        else:
+            has_id = '_id' in ret
+            _id = ret['_id'] if has_id else None
+        if RawBSONDocument != None and isinstance(ret, RawBSONDocument):
+            size = len(ret.raw)
+        elif RawBSONDocument == None or self.mode in ('replace', 'inc'):
+            size = self._estimate_size(ret)
+        else:
+            # Encode just once, which gives the size; the driver then sends
+            # these bytes as they are rather than encoding the document again
+            ret = RawBSONDocument(bson.BSON.encode(ret))
+            size = len(ret.raw)
+        if self.mode == 'insert' or not has_id:
+            # if no _id, do simple insert
+            self.bulk.insert(ret)
+        elif self.mode == 'replace':
+            self.bulk.find({'_id': _id}).upsert().replace_one(ret)
+        elif self.mode == 'inc':
+            self.bulk.find({'_id': _id}).upsert().update_one(
+                {'$inc': dict((k, v) for k, v in ret.iteritems() if k != '_id')}
+            )
+        else:
+            # if _id in ret, search by that and upsert/update_one;
+            # assume that all non-_id, non-$ keys need to be updated with
+            # the $set operator
+            self.bulk.find({'_id': _id}).upsert().update_one(
+                {'$set': ret}
+            )
+        self.size += size
+        self.count += 1
+        self.added += 1
+        return self.size > self.max_bytes or \
+            bool(self.max_count and self.count >= self.max_count)
+
+    def _estimate_size(self, doc):
+        """Returns the size of `doc` in bytes: measured for every STATS_SAMPLE'th
+document, and otherwise taken as the average of those measured
+        """
+        if self.added % STATS_SAMPLE == 0:
+            self.sampled += 1
+            self.sampled_bytes += _doc_size(doc)
+        return self.sampled_bytes // self.sampled
+
+    def flush(self, done=None):
+        """Write out the current bulk op, if it has anything in it
+        @done: optional function to call once it has been written
+        """
+        if self.count == 0:
+            return
+        self.written += self.size
+        if self.queue:
+            self.queue.put((self.bulk, self.count, done))
+        else:
+            t = time.time()
+            self.failed += _write_bulk(self.bulk, self.count,
+                self.write_concern)
+            self.t_write += time.time() - t
+            if done:
+                done()
+        self._new_bulk()
+
+    def close(self):
+        """Wait for any queued bulk ops to be written
+        @return: total number of writes that failed
+        """
+        if self.queue:
+            self.queue.put(None)
+            self.thread.join()
+        return self.failed
+
+
+def _timed(src, times, name):
+    """Generates the items of iterable `src`, adding the seconds spent waiting on
+each one to `times[name]`
+    """
+    src = iter(src)
+    while True:
+        t = time.time()
+        try:
+            item = next(src)
+        finally:
+            times[name] += time.time() - t
+        yield item
+
+
+def _prefetch(src, depth, size=BATCH_SIZE):
+    """Generates the documents of cursor `src`, read ahead in batches of `size` on
+a background thread so that the next batch arrives while the current one is
+processed. At most `depth` batches are held waiting.
+    """
+    batches = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    def read():
+        try:
+            for docs in _batches(src, size):
+                while not stop.is_set():
+                    try:
+                        batches.put(docs, timeout=1)
+                        break
+                    except Queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            batches.put(None)
+        except:
+            batches.put(sys.exc_info())
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            docs = batches.get()
+            if docs == None:
+                return
+            if isinstance(docs, tuple):  # reader raised; re-raise it here
+                raise docs[0], docs[1], docs[2]
+            for doc in docs:
+                yield doc
+    finally:
+        stop.set()
+
+
+# Stands in for the output of a document whose processing raised
+_FAILED = object()
+
+
+def _batches(src, size):
+    """Generates lists of up to `size` consecutive items of iterable `src`
+    """
+    docs = []
+    for doc in src:
+        docs.append(doc)
+        if len(docs) >= size:
+            yield docs
+            docs = []
+    if docs:
+        yield docs
+
+
+def _call_one(proc, doc):
+    """Returns (`doc`, output of `proc` on it), the output being _FAILED if it
+raised
+    """
+    try:
+        return doc, proc(doc)
+    except:
+        _print_proc("***EXCEPTION (process)***")
+        _print_proc(traceback.format_exc())
+        _print_proc("***END EXCEPTION***")
+        return doc, _FAILED
+
+
+def _call_batch(proc, docs):
+    """Returns a list of (document, output) pairs from running batch function
+`proc` on list `docs`. A batch that raises, or returns the wrong number of
+outputs, is retried one document at a time so that a bad document only fails
+itself.
+    """
+    try:
+        rets = proc(docs)
+        if len(rets) != len(docs):
+            raise Exception("batch of {0} documents returned {1} " \
+                "outputs".format(len(docs), len(rets)))
+        return zip(docs, rets)
+    except:
+        _print_proc("***BATCH EXCEPTION (process); retrying singly***")
+        _print_proc(traceback.format_exc())
+        _print_proc("***END EXCEPTION***")
+        return [_call_one(lambda doc: proc([doc])[0], doc) for doc in docs]
+
+
+def _is_future(obj):
+    """Whether `obj` is a future-like object: one with a blocking `result` method,
+such as a concurrent.futures.Future
+    """
+    return callable(getattr(obj, 'result', None))
+
+
+def _resolve(pairs, inflight):
+    """Generates the (document, output) pairs of `pairs`, in order, with outputs
+that are futures replaced by their results. Up to `inflight` pairs are taken
+from `pairs` before waiting on the oldest, so that many outputs can be pending
+at once.
+    """
+    pending = collections.deque()
+    for pair in pairs:
+        pending.append(pair)
+        if len(pending) >= inflight:
+            yield _resolve_one(*pending.popleft())
+    while pending:
+        yield _resolve_one(*pending.popleft())
+
+
+def _resolve_one(doc, ret):
+    """Returns (`doc`, `ret`), waiting on `ret` first if it's a future; a future
+that raised gives _FAILED
+    """
+    if not _is_future(ret):
+        return doc, ret
+    try:
+        return doc, ret.result()
+    except:
+        _print_proc("***EXCEPTION (process)***")
+        _print_proc(traceback.format_exc())
+        _print_proc("***END EXCEPTION***")
+        return doc, _FAILED
+
+
+def _results(proc, src, batch=None, threads=None, in_order=True):
+    """Generates a (document, output) pair for each document of `src`, the output
+being _FAILED if processing raised.
+    @batch: if set, `proc` is a batch function, called on lists of up to `batch`
+documents and returning a list with one output (or None) per document (see
+`_call_batch`)
+    @threads: if set, run `proc` on a pool of this many threads. Up to
+`threads * 4` documents are handed to the pool ahead of the output, so the
+cursor isn't read far ahead, and each output is generated as soon as it's ready,
+so the caller can go on renewing its lease.
+    @in_order: with `threads`, whether outputs must come out in the order of
+`src`
+    """
+    if batch:
+        call = lambda docs: _call_batch(proc, docs)
+        items = _batches(src, batch)
+    else:
+        call = lambda doc: [_call_one(proc, doc)]
+        items = src
+    if not threads:
+        for item in items:
+            for pair in call(item):
+                yield pair
+        return
+    pool = ThreadPool(threads)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(call, (item,)))
+            if len(pending) >= threads * 4:
+                for pair in _pop_done(pending, in_order).get():
+                    yield pair
+        while pending:
+            for pair in _pop_done(pending, in_order).get():
+                yield pair
+    finally:
+        pool.terminate()
+
+
+def _pop_done(pending, in_order):
+    """Removes and returns a result from deque `pending` of AsyncResults: the
+oldest, or if not `in_order`, the first one ready (the oldest if none is)
+    """
+    if not in_order:
+        for i, res in enumerate(pending):
+            if res.ready():
+                del pending[i]
+                return res
+    return pending.popleft()
+
+
+def _get_path(doc, path):
+    """Returns the value of dotted field `path` in `doc`, or None if missing
+    """
+    for part in path.split('.'):
+        if not isinstance(doc, collections.Mapping):
+            return None
+        doc = doc.get(part)
+    return doc
 
 
-def _process(init, proc, src, dest, verbose, hkstart=None):
+class _Lookup(object):
+    """Documents of `collection` looked up by `foreign_field`, cached in an LRU of
+up to `cache_size` entries (including values found to have no document)
+    """
+    def __init__(self, collection, local_field, foreign_field='_id',
+            fields=None, cache_size=100000):
+        self.collection = collection
+        self.local_field = local_field
+        self.foreign_field = foreign_field
+        self.fields = fields
+        self.projection = _projection(fields, foreign_field)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.queries = 0
+
+    def _put(self, value, doc):
+        self.cache.pop(value, None)
+        self.cache[value] = doc
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def prefetch(self, docs):
+        """Fetches the documents that source documents `docs` refer to, and
+aren't cached yet, with one query. If the query fails, the error is logged and
+the documents are left to be looked up one by one.
+        """
+        values = set()
+        for doc in docs:
+            value = _get_path(doc, self.local_field)
+            for v in value if isinstance(value, list) else [value]:
+                if v != None and isinstance(v, collections.Hashable):
+                    values.add(v)
+        with self.lock:
+            missing = [v for v in values if v not in self.cache]
+        if not missing:
+            return
+        found = {}
+        try:
+            for d in self.collection.find(
+                    {self.foreign_field: {'$in': missing}}, self.projection):
+                # An array field matches each of its values
+                value = _get_path(d, self.foreign_field)
+                for v in value if isinstance(value, list) else [value]:
+                    if isinstance(v, collections.Hashable):
+                        found.setdefault(v, d)
+        except Exception:
+            _print_proc("***EXCEPTION (lookup prefetch)***")
+            _print_proc(traceback.format_exc())
+            _print_proc("***END EXCEPTION***")
+            return
+        with self.lock:
+            self.queries += 1
+            for v in missing:
+                self._put(v, found.get(v))
+
+    def get(self, value):
+        """Returns the document whose foreign field is `value`, or None
+        """
+        with self.lock:
+            if value in self.cache:
+                self.hits += 1
+                doc = self.cache.pop(value)
+                self.cache[value] = doc
+                return doc
+            self.misses += 1
+        doc = self.collection.find_one({self.foreign_field: value},
+            self.projection)
+        with self.lock:
+            self.queries += 1
+            self._put(value, doc)
+        return doc
+
+    def counts(self):
+        return {'hits': self.hits, 'misses': self.misses,
+            'queries': self.queries, 'cached': len(self.cache)}
+
+
+_lookups = {}  # This process's lookups, by name
+
+
+def declare_lookup(name, collection, local_field, foreign_field='_id',
+        fields=None, cache_size=100000):
+    """Declares a lookup, typically from `init`, of documents in pymongo
+`collection` whose `foreign_field` matches the `local_field` of source documents
+(or any of its values, for a list). For each batch of source documents,
+`_process` fetches those not cached yet with a single query, so the processing
+function can call `lookup(name, value)` without a round trip per document.
+Declaring the same lookup again, e.g. at the start of each chunk, keeps its cache.
+    @fields: only fetch these fields of the looked up documents
+    @cache_size: keep up to this many looked up documents, dropping the least
+recently used
+    @return: the lookup
+    """
+    lk = _lookups.get(name)
+    if lk == None or (lk.collection, lk.local_field, lk.foreign_field,
+            lk.fields) != (collection, local_field, foreign_field, fields):
+        lk = _lookups[name] = _Lookup(collection, local_field, foreign_field,
+            fields, cache_size)
+    lk.cache_size = cache_size
+    return lk
+
+
+def lookup(name, value):
+    """Returns the document of lookup `name` (see `declare_lookup`) whose foreign
+field equals `value`, or None if there is none; it comes from the lookup's cache
+when it can, and otherwise from a query
+    """
+    return _lookups[name].get(value)
+
+
+def lookup_stats():
+    """Returns the hits, misses, queries and cached documents so far of each of
+this process's lookups, by name
+    """
+    return dict((name, lk.counts()) for name, lk in _lookups.iteritems())
+
+
+def _with_lookups(src, lookups, size=BATCH_SIZE):
+    """Generates the documents of `src`, prefetching what each of `lookups` needs
+for every `size` of them
+    """
+    for docs in _batches(src, size):
+        for lk in lookups:
+            lk.prefetch(docs)
+        for doc in docs:
+            yield doc
+
+
+def _process(init, proc, src, dest, verbose, hkstart=None, stats=None,
+        batch=None, write_queue=0, prefetch=0, write_bytes=WRITE_THRESHOLD,
+        write_count=None, write_mode='auto', write_concern=None, ordered=False,
+        threads=None, in_order=False, inflight=None, heartbeat=30,
+        split_key=None, checkpoint=None, resume=None):
     """Run process `proc` on cursor `src`.
     @hkstart: primary key of houskeeping chunk that this is processing, if you are
 using one and which to avoid collisions
+    @stats: optional dict, filled in with the number of documents read ('total')
+and of failed writes ('write_errors'), the seconds spent reading the source
+('t_read'), in `proc` ('t_proc'), building bulk ops ('t_build') and executing
+them ('t_write'), the bytes read (estimated from every STATS_SAMPLE'th document)
+and written, the seconds taken ('elapsed'), documents read per second ('rate'),
+the process ('worker') and, for each lookup, the hits, misses and queries
+('lookups'; see `declare_lookup`)
+    @batch: if set, call `proc` on lists of this many documents (see `_results`)
+    @write_queue: if set, execute bulk writes on a background thread, with at most
+this many waiting (see `_BulkWriter`)
+    @prefetch: if set, read the source cursor on a background thread, with at most
+this many batches waiting (see `_prefetch`)
+    @write_bytes, write_count: write the buffered output once it passes this many
+bytes or documents
+    @write_mode, write_concern, ordered: how output is written (see `_BulkWriter`)
+    @threads: if set, run `proc` on a pool of this many threads, keeping the
+output in cursor order if `in_order` (see `_results`)
+    @inflight: if set, `proc` (and `init`) may return futures; up to this many
+outputs are left pending before waiting on the oldest (see `_resolve`)
+    @heartbeat: renew the lease on chunk `hkstart` at least every this many
+seconds, as well as before each write
+    @split_key: if `src` is sorted ascending by this field, publish the position
+reached in it at each renewal, and let idle processes split off the rest of the
+chunk (see `_request_split`)
+    @checkpoint: if `src` is sorted by this field, record a checkpoint on chunk
+`hkstart` after each write: the last value of the field all of whose entries
+have been written, with the counts so far
+    @resume: checkpoint that `src` starts after, to carry the counts on from
     """
     if not verbose & 1:
         oldstdout = sys.stdout
@@ -142,112 +1091,285 @@ using one and which to avoid collisions
             # Pass a copy of the source and destination cursors so they won't
             # affect iteration in the rest of _process
             context = init(_copy_cursor(src), _copy_cursor(dest))
+            if _is_future(context):
+                context = context.result()
         except:
             _print_proc("***EXCEPTION (process)***")
             _print_proc(traceback.format_exc())
             _print_proc("***END EXCEPTION***")
             return 0
-    good = 0
-    # After you've accumulated this many bytes of objects, execute the bulk
-    # write and start it over
-    WRITE_THRESHOLD = 10000000
+    good = resume['good'] if resume else 0
     inserts = 0
     # Before starting, check if some other process has taken over; in that
     # case, exit early with -1
-    if not _is_okay_to_work_on(hkstart):
+    if not _renew_lease(hkstart):
         return -1
-    bulk = dest.initialize_unordered_bulk_op()
+    renewed = time.time()
+    if write_mode == 'auto':
+        # Without housekeeping, match the `save` semantics of replacing by _id
+        write_mode = 'set' if hkstart != None else 'replace'
+    writer = _BulkWriter(dest, write_bytes, write_count, write_queue,
+        write_mode, write_concern, ordered)
     src.batch_size(BATCH_SIZE)
-    insert_size = 0  # Size, in bytes, of all objects to be written
-    insert_count = 0 # Number of inserts
-    for doc in src:
-        try:
-            ret = proc(doc)
-            if ret != None:
-                # If doing housekeeping, save for bulk insert since that will know
-                # whether these would be duplicate inserts
-                if hkstart:
-                    # if _id in ret, search by that and upsert/update_one;
-                    # assume that all non-_id, non-$ keys need to be updated with
-                    # the $set operator
-                    if '_id' in ret:
-                        bulk.find({'_id': ret['_id']}).upsert().update_one(
-                            {'$set': ret}
-                        )
-                    else:
-                        # if no _id, do simple insert
-                        bulk.insert(ret)
-                    insert_size += _doc_size(ret)
-                    insert_count += 1
-                    # If past the threshold, do another check and write
-                    if insert_size > WRITE_THRESHOLD:
-                        if not _is_okay_to_work_on(hkstart):
+    docs = _prefetch(src, prefetch) if prefetch else src
+    times = {'t_read': 0.0, 't_results': 0.0, 't_build': 0.0}
+    docs = _timed(docs, times, 't_read')
+    # Any lookups declared by now, e.g. in `init`, are prefetched batch by batch
+    lookups = _lookups.copy()
+    lookups_before = lookup_stats()
+    if lookups:
+        docs = _with_lookups(docs, lookups.values())
+    tbegin = time.time()
+    sampled = sampled_bytes = 0
+    seen = first_seen = resume['seen'] if resume else 0
+    # `checkpoint` value of the entries being read, and the checkpoint covering
+    # every entry before them
+    current = nothing = object()
+    mark = None
+    if hkstart == None:
+        checkpoint = None
+    # Where the chunk ends, once part of it has been split off
+    limits = {'end': None, 'end_exclusive': False} if split_key else None
+    pos = None
+    try:
+        results = _results(proc, docs, batch, threads, in_order)
+        if inflight:
+            results = _resolve(results, inflight)
+        # Time spent getting results, less that spent reading, is spent in proc
+        results = _timed(results, times, 't_results')
+        for doc, ret in results:
+            if split_key:
+                pos = doc.get(split_key)
+                end = limits['end']
+                if end != None and (pos >= end if limits['end_exclusive']
+                        else pos > end):
+                    break  # The rest now belongs to another chunk
+            if checkpoint:
+                value = _get_path(doc, checkpoint)
+                if value != current:
+                    # Can't resume after a missing value, so don't mark one
+                    if current is not nothing and current != None:
+                        mark = {'value': current, 'good': good, 'seen': seen}
+                    current = value
+            if seen % STATS_SAMPLE == 0:
+                sampled += 1
+                sampled_bytes += _doc_size(doc)
+            seen += 1
+            if hkstart != None and time.time() - renewed > heartbeat:
+                if not _renew_lease(hkstart, seen, pos, limits):
+                    return -1
+                renewed = time.time()
+            if ret is _FAILED:
+                continue
+            try:
+                if ret != None:
+                    # Save for bulk write; if past the threshold, do another
+                    # check and write
+                    t = time.time()
+                    full = writer.add(ret)
+                    times['t_build'] += time.time() - t
+                    if full:
+                        if not _renew_lease(hkstart, seen, pos, limits):
                             return -1
+                        renewed = time.time()
                         print u"Writing to chunk {0} : {1} docs totaling " \
-                            u"{2} bytes".format(hkstart, insert_count, insert_size)
+                            u"{2} bytes".format(hkstart, writer.count,
+                            writer.size)
                         sys.stdout.flush()
-                        _write_bulk(bulk)
-                        bulk = dest.initialize_unordered_bulk_op()
-                        insert_size = 0
-                        insert_count = 0
-                else:
-                    # No housekeeping checks, so save immediately with DB check
-                    dest.save(ret)
-                inserts += 1
-            good += 1
-        except:
-            _print_proc("***EXCEPTION (process)***")
-            _print_proc(traceback.format_exc())
-            _print_proc("***END EXCEPTION***")
-    # After processing, check again if okay to insert
-    sys.stdout.flush()
-    if not _is_okay_to_work_on(hkstart):
-        return -1
-    if hkstart:  # Do bulk insert only if doing housekeeping
-        if insert_count > 0:
-            _print_proc(u"Writing to chunk {0} : {1} docs totaling {2} " \
-                u"bytes".format(hkstart, insert_count, insert_size))
-            _write_bulk(bulk)
-        else:
+                        done = None
+                        if mark != None:
+                            done = lambda mark=mark: _save_checkpoint(hkstart,
+                                mark, writer)
+                        writer.flush(done)
+                    inserts += 1
+                good += 1
+            except:
+                _print_proc("***EXCEPTION (process)***")
+                _print_proc(traceback.format_exc())
+                _print_proc("***END EXCEPTION***")
+        # After processing, check again if okay to insert
+        sys.stdout.flush()
+        if not _renew_lease(hkstart, seen, pos, limits):
+            return -1
+        if writer.count > 0:
+            if hkstart != None:
+                _print_proc(u"Writing to chunk {0} : {1} docs totaling {2} " \
+                    u"bytes".format(hkstart, writer.count, writer.size))
+            writer.flush()
+        elif hkstart != None:
             _print_proc(u"No bulk writes to do at end of chunk" \
                 u" {0}".format(hkstart))
+    finally:
+        # Failed writes don't count as successfully processed
+        failed = writer.close()
+    good -= failed
     if not verbose & 1:
         sys.stdout = oldstdout
     sys.stdout.flush()
+    if stats != None:
+        elapsed = time.time() - tbegin
+        stats.update({
+            'total': seen,
+            'write_errors': failed,
+            't_read': times['t_read'],
+            't_proc': max(0.0, times['t_results'] - times['t_read']),
+            't_build': times['t_build'],
+            't_write': writer.t_write,
+            'bytes_read': sampled_bytes * (seen - first_seen) // sampled
+                if sampled else 0,
+            'bytes_written': writer.written,
+            'elapsed': elapsed,
+            'rate': (seen - first_seen) / elapsed if elapsed else 0.0,
+            'worker': procname(),
+        })
+        if lookups:
+            stats['lookups'] = dict((name, dict((k, n - lookups_before[name][k]
+                if k != 'cached' else n) for k, n in lk.counts().iteritems()))
+                for name, lk in lookups.iteritems())
     return good
 
 
 context = {}
+worker_context = {}  # What `worker_init` returned, for the whole process
 
 
-def do_chunks(init, proc, src_col, dest_col, query, key, sort, verbose, sleep=60):
-    while housekeep.objects(state = 'done').count() < housekeep.objects.count():
-        tnow = datetime.datetime.utcnow()
-        raw = housekeep._collection.find_and_modify(
-            {'state': 'open'},
-            {
-                '$set': {
-                    'state': 'working',
-                    'tstart': tnow,
-                    'procname': procname(),
-                }
-            }
-        )
-        # if raw==None, someone scooped us
-        if raw != None:
-            raw_id = raw['_id']
-            #reload as mongoengine object -- _id is .start (because set as primary_key)
-            hko = housekeep.objects(start = raw_id)[0]
+def _run_worker_init(worker_init, src_col, dest_col, verbose=1):
+    """Runs `worker_init(src_col, dest_col)` and keeps what it returns as
+`worker_context`; done once in the parent before workers are forked, so that
+they share its data copy-on-write, or once at the start of each worker
+    """
+    global worker_context
+    t0 = time.time()
+    worker_context = worker_init(src_col, dest_col)
+    if _is_future(worker_context):
+        worker_context = worker_context.result()
+    if worker_context is None:  # not ==, which NumPy arrays compare elementwise
+        worker_context = {}
+    if verbose & 2:
+        print "worker_init took %.1f seconds" % (time.time() - t0)
+        sys.stdout.flush()
+    return worker_context
+
+
+def shared_array(shape, dtype='float64'):
+    """Returns a zeroed NumPy array in anonymous shared memory. Made before
+workers are forked, e.g. by `worker_init`, it is the same memory in all of them,
+so writes by any process are seen by the others.
+    """
+    import numpy
+    import mmap as mmap_module
+    dtype = numpy.dtype(dtype)
+    count = int(numpy.prod(shape))
+    buf = mmap_module.mmap(-1, max(count * dtype.itemsize, 1))
+    return numpy.frombuffer(buf, dtype, count).reshape(shape)
+
+
+def load_array(path, mode='r'):
+    """Memory-maps the NumPy array saved (with `numpy.save`) at `path`; its pages
+are read in as they are used and, being file-backed, are shared by all processes
+on the host rather than copied into each
+    @mode: as `mmap_mode` of `numpy.load`; the default, 'r', is read-only
+    """
+    import numpy
+    return numpy.load(path, mmap_mode=mode)
+
+
+def do_chunks(init, proc, src_col, dest_col, query, key, sort, verbose, sleep=60,
+        rebalance=None, batch=None, write_queue=0, prefetch=0,
+        write_bytes=WRITE_THRESHOLD, write_count=None, write_mode='auto',
+        write_concern=None, ordered=False, threads=None, inflight=None,
+        heartbeat=30, speculate=0, speculate_after=60, split=False,
+        split_min=100, claim=1, checkpoint=False, profile=0, profile_dir='.',
+        fields=None, raw=False, worker_init=None):
+    """Claim and process chunks until all are done.
+    @worker_init: run this once, before claiming any chunk (see
+`_run_worker_init`)
+    @fields: only read these fields of the source documents (and `key` and
+`sort`, which processing needs)
+    @raw: pass `proc` RawBSONDocuments, which only decode the fields it reads
+    @profile: run this fraction of chunks under cProfile, dumping the stats for
+each to "<host>_<pid>_<chunk>.prof" in `profile_dir` (see `merge_profiles`);
+only the calling thread is profiled, so not callbacks run with `threads`
+    @checkpoint: record a checkpoint after each write, and start chunks that have
+one after its `sort` value rather than from the beginning (see `_process`)
+    @claim: claim up to this many open chunks at a time, to work through from a
+local queue; each chunk is marked done as the next one starts, in the same bulk
+write that renews the queued chunks' leases. Saves round trips to the
+housekeeping collection when chunks are small. Queued chunks only have their
+leases renewed as each one is started, so keep every chunk well within the
+timeout.
+    @split: when no chunks are open, ask the worker on a chunk with at least
+`split_min` entries left to split off its upper half (see `_request_split`);
+only possible when chunks are sorted by `key`
+    @speculate: when no chunks are open, start a backup copy of the
+longest-running chunk that has been working for over `speculate_after` seconds
+and has fewer than this many backups already; the first copy to finish marks
+the chunk done and the others give up at their next lease renewal
+    Remaining params are as for `_process`.
+    """
+    if worker_init:
+        _run_worker_init(worker_init, src_col, dest_col, verbose)
+    read_col = _raw_collection(src_col) if raw else src_col
+    projection = _projection(fields, key, sort.lstrip("-"))
+    queue = []     # Chunks claimed but not started yet
+    finished = []  # (start, good, total, stats) of chunks not marked done yet
+    while True:
+        chunk = None
+        backup = False
+        if not queue:
+            _finish_chunks(finished)
+            finished = []
+            # Stop once no chunk is left open or working
+            if housekeep._collection.find_one({'state': {'$ne': 'done'}},
+                    ['_id']) == None:
+                break
+            queue = _claim_chunks(claim)
+        if queue:
+            chunk = queue.pop(0)
+            if claim > 1:
+                # Mark chunks done as they finish, so that they aren't taken for
+                # stragglers, and keep the leases of those still queued
+                _finish_chunks(finished, [c['_id'] for c in queue])
+                finished = []
+                if not _start_chunk(chunk['_id']):
+                    print "Chunk at %s lost while queued; skipping" % (
+                        chunk['_id'])
+                    sys.stdout.flush()
+                    continue
+        if chunk == None and split and sort == key:
+            if _request_split(src_col, query, key, split_min, verbose):
+                # Give the worker a heartbeat to split off the new chunk
+                time.sleep(min(sleep, heartbeat))
+                continue
+        if chunk == None and speculate:
+            chunk = _claim_backup(speculate, speculate_after)
+            backup = chunk != None
+        # if chunk==None, someone scooped us
+        if chunk != None:
+            raw_id = chunk['_id']
+            if backup:
+                print "Starting backup copy of straggling chunk %s" % raw_id
+            # as mongoengine object -- _id is .start (because set as primary_key)
+            hko = housekeep._from_son(chunk)
             # Record git commit for sanity
 #             hko.git = git.Git('.').rev_parse('HEAD')
 #             hko.save()
+            resume = hko.checkpoint if checkpoint and not backup else None
+            if resume and resume.get('value') == None:
+                resume = None  # Nothing to resume after; start over
+            if rebalance and hko.estimated and not backup and not resume:
+                _rebalance(src_col, query, key, hko, rebalance, verbose)
             # get data pointed to by housekeep
-            qq = {'$and': [query, {key: {'$gte': hko.start}}, {key: {'$lte': hko.end}}]}
+            qq = _chunk_query(query, key, hko.start, hko.end, hko.end_exclusive)
+            if resume:
+                print "Resuming chunk %s after %s" % (raw_id, resume['value'])
+                op = '$lt' if sort[0] == "-" else '$gt'
+                qq = {'$and': [qq, {sort.lstrip("-"): {op: resume['value']}}]}
             # Make cursor not timeout, using version-appropriate paramater
             if pymongo.version_tuple[0] == 2:
-                cursor = src_col.find(qq, timeout=False)
+                cursor = read_col.find(qq, projection, timeout=False)
             elif pymongo.version_tuple[0] == 3:
-                cursor = src_col.find(qq, no_cursor_timeout=True)
+                cursor = read_col.find(qq, projection, no_cursor_timeout=True)
             else:
                 raise Exception("Unknown pymongo version")
             # Set the sort parameters on the cursor
@@ -255,24 +1377,37 @@ def do_chunks(init, proc, src_col, dest_col, query, key, sort, verbose, sleep=60
                 cursor = cursor.sort(sort[1:], pymongo.DESCENDING)
             else:
                 cursor = cursor.sort(sort, pymongo.ASCENDING)
-            if verbose & 2: print "mongo_process: %d elements in chunk %s-%s" % (cursor.count(), hko.start, hko.end)
+            if verbose & 2: print "mongo_process: about %d elements in chunk %s-%s" % (hko.total, hko.start, hko.end)
             sys.stdout.flush()
             # This is where processing happens
+            stats = {}
+            prof = None
+            if profile and random.random() < profile:
+                prof = cProfile.Profile()
+                prof.enable()
             hko.good =_process(init, proc, cursor, dest_col, verbose,
-                hkstart=raw_id)
-            # Check if another job finished it while this one was plugging away
-            hko_later = housekeep.objects(start = raw_id).only('state')[0]
+                hkstart=raw_id, stats=stats, batch=batch,
+                write_queue=write_queue, prefetch=prefetch,
+                write_bytes=write_bytes, write_count=write_count,
+                write_mode=write_mode, write_concern=write_concern,
+                ordered=ordered, threads=threads, in_order=bool(sort),
+                inflight=inflight, heartbeat=heartbeat,
+                split_key=key if split and sort == key and not backup else None,
+                checkpoint=sort.lstrip("-") if checkpoint and not backup else None,
+                resume=resume)
+            if prof:
+                prof.disable()
+                prof.dump_stats(os.path.join(profile_dir, "%s_%d_%s.prof" % (
+                    socket.gethostname(), os.getpid(),
+                    re.sub(r'[^\w.-]', '_', unicode(raw_id)))))
             if hko.good == -1:  # Early exit signal
                 print "Chunk at %s lost to another process; not updating" % raw_id
                 sys.stdout.flush()
-            elif hko_later.state == 'done':
-                print "Chunk at %s had already finished; not updating" % raw_id
-                sys.stdout.flush()
             else:
-                hko.state = 'done'
-                hko.procname = 'none'
-                hko.time = datetime.datetime.utcnow()
-                hko.save()
+                finished.append((raw_id, hko.good,
+                    stats.get('total', hko.total)
+                        if hko.estimated or split else None,
+                    stats))
         else:
             # Not all done, but none were open for processing; thus, wait to
             # see if one re-opens
@@ -281,11 +1416,349 @@ def do_chunks(init, proc, src_col, dest_col, query, key, sort, verbose, sleep=60
             time.sleep(sleep)
 
 
-def _num_not_at_state(state):
-    """Helper for consisely counting the number of housekeeping objects at a
-given state
+def _claim_chunks(count):
+    """Claims up to `count` open chunks for this process: with one find_and_modify
+for a single chunk, otherwise with a read of open chunk ids, one update of a
+random sample of those still open, and a read back of the ones this process won.
+Chunks claimed in a batch have no `tstart` until `_start_chunk`, so that queued
+chunks aren't taken for stragglers. If other workers won all of the sample, falls
+back to claiming a single chunk rather than standing by.
+    @return: list of raw chunks claimed, in `start` order
     """
-    return housekeep.objects(state__ne=state).count()
+    col = housekeep._collection
+    me = procname()
+    tnow = datetime.datetime.utcnow()
+    claim = {
+        '$set': {
+            'state': 'working',
+            'tstart': tnow,
+            'heartbeat': tnow,
+            'progress': 0,
+            'procname': me,
+            'backups': [],
+            'position': None,
+            'split_at': None,
+        }
+    }
+    if count <= 1:
+        raw = col.find_and_modify({'state': 'open'}, claim)
+        return [raw] if raw != None else []
+    # Sample from more open chunks than wanted, so that workers claiming at the
+    # same time mostly go for different ones
+    ids = [c['_id'] for c in
+        col.find({'state': 'open'}, ['_id']).limit(count * 4)]
+    if not ids:
+        return []
+    ids = random.sample(ids, min(count, len(ids)))
+    claim['$set']['tstart'] = None
+    _update_many(col, {'_id': {'$in': ids}, 'state': 'open'}, claim)
+    won = list(col.find({'_id': {'$in': ids}, 'state': 'working',
+        'procname': me}).sort('_id', pymongo.ASCENDING))
+    return won or _claim_chunks(1)
+
+
+def _start_chunk(hkstart):
+    """Starts the lease on queued chunk `hkstart` as work on it begins
+    @return: whether chunk `hkstart` is still this process's to work on
+    """
+    tnow = datetime.datetime.utcnow()
+    return bool(_update_one(housekeep._collection, {'_id': hkstart,
+        'state': 'working', 'procname': procname()},
+        {'$set': {'tstart': tnow, 'heartbeat': tnow}}))
+
+
+def _request_split(src_col, query, key, min_left, verbose):
+    """Asks the worker on the longest-running splittable chunk that has an
+estimated `min_left` entries left to read (its total less its progress) to split
+off the upper half of them; the worker answers at its next lease renewal (see
+`_accept_split`). The split point is the first key past the middle of the range
+of keys left, found with indexed probes rather than a count, so that equal keys
+stay together; keys whose type has no arithmetic aren't split.
+    @return: whether a split was requested
+    """
+    me = procname()
+    chunks = housekeep._collection.find({
+        'state': 'working',
+        'procname': {'$ne': me},
+        'position': {'$ne': None},
+        'split_at': None,
+        'backups': {'$size': 0},
+    }).sort([('tstart', pymongo.ASCENDING)]).limit(10)
+    for chunk in chunks:
+        left = (chunk.get('total') or 0) - (chunk.get('progress') or 0)
+        if left < min_left:
+            continue
+        end = {'$lt' if chunk.get('end_exclusive') else '$lte': chunk['end']}
+        last = list(src_col.find({'$and': [query,
+            {key: dict(end, **{'$gt': chunk['position']})}]},
+            [key]).sort([(key, pymongo.DESCENDING)]).limit(1))
+        if not last or last[0].get(key) == None:
+            continue
+        try:
+            mid = _range_points(chunk['position'], last[0][key], 2)
+        except (ValueError, TypeError):  # no arithmetic on these keys
+            continue
+        if not mid:
+            continue
+        first = list(src_col.find({'$and': [query,
+            {key: dict(end, **{'$gte': mid[0]})}]},
+            [key]).sort([(key, pymongo.ASCENDING)]).limit(1))
+        if not first or first[0].get(key) == None:
+            continue
+        split_at = first[0][key]
+        split_total = left // 2
+        if _update_one(housekeep._collection,
+                {'_id': chunk['_id'], 'state': 'working',
+                    'procname': chunk['procname'], 'split_at': None},
+                {'$set': {'split_at': split_at, 'split_total': split_total}}):
+            if verbose & 2: print "Asked {0} to split chunk {1} at {2}".format(
+                chunk['procname'], chunk['_id'], split_at)
+            sys.stdout.flush()
+            return True
+    return False
+
+
+def _claim_backup(max_backups, min_age):
+    """Adds this process as a backup worker on the longest-running "working" chunk
+that started over `min_age` seconds ago, isn't already this process's and has
+fewer than `max_backups` backups
+    @return: the raw chunk claimed, or None if none qualify
+    """
+    me = procname()
+    return housekeep._collection.find_and_modify(
+        {
+            'state': 'working',
+            'procname': {'$ne': me},
+            'backups': {'$ne': me},
+            'backups.%d' % (max_backups - 1): {'$exists': False},
+            'tstart': {'$lt': datetime.datetime.utcnow() -
+                datetime.timedelta(seconds=min_age)},
+        },
+        {'$push': {'backups': me}},
+        sort=[('tstart', pymongo.ASCENDING)]
+    )
+
+
+def _finish_chunk(hkstart, good, total=None, stats=None):
+    """Marks a chunk done with `good` entries processed (and `total` entries and
+the worker's `stats`, if given), provided this process still holds it as its
+worker or a backup; with backups, the first copy to finish wins
+    @return: whether the chunk was marked done
+    """
+    me = procname()
+    fields = {
+        'set__state': 'done',
+        'set__procname': 'none',
+        'set__backups': [],
+        'set__good': good,
+        'set__time': datetime.datetime.utcnow(),
+    }
+    if total != None:
+        fields['set__total'] = total
+    if stats:
+        fields['set__stats'] = stats
+    return housekeep.objects(meng.Q(procname=me) | meng.Q(backups=me),
+        start=hkstart, state='working').update(**fields)
+
+
+def _finish_chunks(finished, renew=()):
+    """Marks the chunks in `finished`, a list of (start, good, total, stats) tuples, done
+as `_finish_chunk` does, and renews this process's leases on the queued chunks in
+`renew`, with a single bulk write when there is more than one chunk
+    """
+    if not finished and not renew:
+        return
+    if len(finished) == 1 and not renew:
+        done = _finish_chunk(*finished[0])
+    else:
+        me = procname()
+        tnow = datetime.datetime.utcnow()
+        bulk = housekeep._get_collection().initialize_unordered_bulk_op()
+        for hkstart, good, total, stats in finished:
+            fields = {'state': 'done', 'procname': 'none', 'backups': [],
+                'good': good, 'time': tnow}
+            if total != None:
+                fields['total'] = total
+            if stats:
+                fields['stats'] = stats
+            bulk.find({'_id': hkstart, 'state': 'working',
+                '$or': [{'procname': me}, {'backups': me}]}).update_one(
+                {'$set': fields})
+        if renew:
+            bulk.find({'_id': {'$in': list(renew)}, 'state': 'working',
+                'procname': me}).update({'$set': {'heartbeat': tnow}})
+        done = bulk.execute()['nMatched']
+    # Fewer if other jobs finished some while this one was plugging away, or
+    # queued chunks were reopened
+    if done < len(finished) + len(renew):
+        print "%d of %d chunks had already finished or been reopened; " \
+            "not updating" % (len(finished) + len(renew) - done,
+            len(finished) + len(renew))
+        sys.stdout.flush()
+
+
+def _prefix_query(query, prefix):
+    """Returns `query` with every field name prefixed by `prefix`, e.g. to apply a
+source query to the `fullDocument` of change stream events
+    """
+    if isinstance(query, list):
+        return [_prefix_query(q, prefix) for q in query]
+    if not isinstance(query, dict):
+        return query
+    return dict((k if k.startswith('$') else prefix + k,
+        _prefix_query(v, prefix) if k in ('$and', '$or', '$nor') else v)
+        for k, v in query.iteritems())
+
+
+def _change_events(src_col, query, resume, verbose):
+    """Generates (document, resume token) for each document of `src_col` matching
+`query` that is inserted or updated from now on, or from after resume token
+`resume` if given. Uses a change stream where the server supports one (3.6+)
+and pymongo can poll it (3.8+), and otherwise tails the oplog, whose tokens are
+timestamps. Generates
+(None, None) whenever no change has come in for a while. Raises if `resume`
+can't be resumed from, rather than skip the changes since.
+    """
+    if resume == None or not isinstance(resume, bson.Timestamp):
+        started = False
+        try:
+            for event in _change_stream(src_col, query, resume):
+                started = True
+                yield event
+            return
+        except AttributeError:  # pymongo before 3.8
+            if started:
+                raise
+        except pymongo.errors.OperationFailure as e:
+            # Only fall back if the server couldn't open a change stream at all
+            if started:
+                raise
+            if e.code not in NO_CHANGE_STREAMS:
+                if resume != None:
+                    raise Exception("Can't resume following after %s (%s); " \
+                        "delete the saved token to follow from now" % (
+                        resume, e))
+                raise
+        if resume != None:
+            raise Exception("Can't resume following after change stream " \
+                "token %s without change streams" % resume)
+        if verbose & 2: print "no change streams; tailing the oplog"
+    for event in _tail_oplog(src_col, query, resume):
+        yield event
+
+
+def _change_stream(src_col, query, resume):
+    """Change stream flavor of `_change_events`
+    """
+    pipeline = [{'$match': {'$and': [
+        {'operationType': {'$in': ['insert', 'update', 'replace']}},
+        _prefix_query(query, 'fullDocument.')]}}]
+    stream = src_col.watch(pipeline, full_document='updateLookup',
+        resume_after=resume, max_await_time_ms=1000)
+    with stream:
+        # pymongo 3.6 and 3.7 can only wait for the next change, holding back
+        # the changes read so far while the source is quiet; tail the oplog
+        if not hasattr(stream, 'try_next'):
+            raise AttributeError("change streams can't be polled before "
+                "pymongo 3.8")
+        while True:
+            event = stream.try_next()
+            if event == None:
+                yield None, None
+            elif event.get('fullDocument') != None:  # None if since deleted
+                yield event['fullDocument'], event['_id']
+
+
+def _tail_oplog(src_col, query, resume):
+    """Oplog flavor of `_change_events`, for servers without change streams; the
+source must be part of a replica set
+    """
+    if pymongo.version_tuple[0] == 2:
+        oplog = src_col.database.connection.local['oplog.rs']
+    else:
+        oplog = src_col.database.client.local['oplog.rs']
+    if 'oplog.rs' not in oplog.database.collection_names():
+        raise Exception("No oplog to follow; the source must be part of a " \
+            "replica set (a single-node one will do)")
+    if resume == None:
+        last = list(oplog.find().sort('$natural', pymongo.DESCENDING).limit(1))
+        resume = last[0]['ts'] if last else bson.Timestamp(0, 0)
+    else:
+        first = list(oplog.find().sort('$natural', pymongo.ASCENDING).limit(1))
+        if first and first[0]['ts'] > resume:
+            raise Exception("Can't resume following after %s; the oplog now " \
+                "starts at %s. Delete the saved token to follow from now" % (
+                resume, first[0]['ts']))
+    ns = "%s.%s" % (src_col.database.name, src_col.name)
+    while True:
+        qq = {'ts': {'$gt': resume}, 'ns': ns, 'op': {'$in': ['i', 'u']}}
+        if pymongo.version_tuple[0] == 2:
+            cursor = oplog.find(qq, tailable=True, await_data=True,
+                oplog_replay=True)
+        else:
+            cursor = oplog.find(qq, oplog_replay=True,
+                cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+        while cursor.alive:
+            for entry in cursor:
+                resume = entry['ts']
+                if entry['op'] == 'i' and not query:
+                    doc = entry['o']
+                else:
+                    # Updates only log the change, so read the document back
+                    _id = entry['o2' if entry['op'] == 'u' else 'o']['_id']
+                    doc = src_col.find_one({'$and': [{'_id': _id}, query]})
+                if doc != None:
+                    yield doc, resume
+            yield None, None
+        time.sleep(1)
+
+
+def _follow(init, proc, src_col, dest_col, query, verbose, state_col,
+        batch=None, write_bytes=WRITE_THRESHOLD, write_count=None,
+        write_mode='auto', write_concern=None, ordered=False):
+    """Keep `dest_col` up to date by running `proc` on every document inserted
+into or updated in `src_col` (see `_change_events`), until interrupted.
+Documents are processed in batches and written through `_BulkWriter`; after
+each write, the resume token of the last document is saved in `state_col`, so
+that a restarted follower carries on from there.
+    Remaining params are as for `_process`; write_mode 'auto' means 'set'.
+    """
+    global context
+    if init:
+        context = init(src_col.find(query), dest_col)
+        if _is_future(context):
+            context = context.result()
+    state = state_col.find_one({'_id': 'resume'})
+    resume = state['token'] if state else None
+    if verbose & 2: print "following %s from %s" % (src_col.name, resume or "now")
+    sys.stdout.flush()
+    writer = _BulkWriter(dest_col, write_bytes, write_count, 0,
+        'set' if write_mode == 'auto' else write_mode, write_concern, ordered)
+    docs = []
+    for doc, token in _change_events(src_col, query, resume, verbose):
+        if doc != None:
+            docs.append(doc)
+            resume = token
+        if docs and (doc == None or len(docs) >= (batch or BATCH_SIZE)):
+            _follow_write(proc, docs, batch, writer, state_col, resume, verbose)
+            docs = []
+    if docs:
+        _follow_write(proc, docs, batch, writer, state_col, resume, verbose)
+
+
+def _follow_write(proc, docs, batch, writer, state_col, resume, verbose):
+    """Process list `docs` for `_follow`, write the output through `writer`, then
+save `resume` as the token to restart from
+    """
+    for doc, ret in _results(proc, docs, batch):
+        if ret is not _FAILED and ret != None and writer.add(ret):
+            writer.flush()
+    if writer.count > 0:
+        if verbose & 2: print "following: writing %d docs" % writer.count
+        writer.flush()
+    state_col.update({'_id': 'resume'}, {'$set': {'token': resume}},
+        upsert=True)
+    sys.stdout.flush()
 
 
 # balance chunk size vs async efficiency etc
@@ -314,6 +1787,8 @@ def mmap(   cb,
             source_col,
             dest_col,
             init=None, 
+            worker_init=None,
+            worker_init_each=False,
             reset=False,
             source_uri="mongodb://127.0.0.1/test", 
             dest_uri="mongodb://127.0.0.1/test",
@@ -329,6 +1804,37 @@ def mmap(   cb,
             chunk_size=None,
             timeout=120,
             sleep=60,
+            heartbeat=None,
+            speculate=0,
+            speculate_after=60,
+            split=False,
+            split_min=100,
+            claim=1,
+            checkpoint=False,
+            profile=0,
+            profile_dir='.',
+            metrics_port=None,
+            metrics_log=None,
+            metrics_window=600,
+            metrics_host='127.0.0.1',
+            fields=None,
+            raw=False,
+            partition='exact',
+            rebalance=None,
+            sample_size=10000,
+            incremental=False,
+            follow=False,
+            batch=None,
+            write_queue=0,
+            prefetch=0,
+            write_bytes=WRITE_THRESHOLD,
+            write_count=None,
+            write_mode='auto',
+            w=None,
+            j=None,
+            ordered=False,
+            threads=None,
+            inflight=None,
             **kwargs):
 
     # Two different connect=False idioms; need to set it false to wait on
@@ -346,70 +1852,269 @@ def mmap(   cb,
         ).get_default_database()
         dbd = pymongo.MongoClient(dest_uri, connect=False).get_default_database()
     dest = dbd[dest_col]
-    if multi == None:  # don't use housekeeping, run straight process
+    if write_mode not in WRITE_MODES:
+        raise Exception("Unknown write mode %s" % write_mode)
+    if raw and RawBSONDocument == None:
+        raise Exception("Raw mode needs pymongo 3.2 or later")
+    write_concern = {}
+    if w != None:
+        write_concern['w'] = w
+    if j != None:
+        write_concern['j'] = j
+    write_concern = write_concern or None
+    if worker_init and not init_only and not manage_only and \
+            (follow or multi == None or not worker_init_each):
+        # Before any worker is forked, so they share what it loads
+        _run_worker_init(worker_init, dbs[source_col], dest, verbose)
+    if follow:  # keep processing changes to the source as they come in
+        _connect(dbs[source_col], dest, dest_uri)
+        state_col = housekeep._get_collection().database[
+            housekeep._get_collection_name() + '_follow']
+        _follow(init, cb, dbs[source_col], dest, query, verbose, state_col,
+            batch=batch, write_bytes=write_bytes, write_count=write_count,
+            write_mode=write_mode, write_concern=write_concern, ordered=ordered)
+    elif multi == None:  # don't use housekeeping, run straight process
 
-        source = dbs[source_col].find(query)
-        _process(init, cb, source, dest, verbose)
+        read_col = _raw_collection(dbs[source_col]) if raw else \
+            dbs[source_col]
+        source = read_col.find(query, _projection(fields))
+        _process(init, cb, source, dest, verbose, batch=batch,
+            write_queue=write_queue, prefetch=prefetch, write_bytes=write_bytes,
+            write_count=write_count, write_mode=write_mode,
+            write_concern=write_concern, ordered=ordered, threads=threads,
+            inflight=inflight)
     else:
         _connect(dbs[source_col], dest, dest_uri)
         if manage_only:
-            manage(timeout, sleep)
+            manage(timeout, sleep, metrics_port, metrics_log, metrics_window,
+                metrics_host)
         elif not process_only:
-            computed_chunk_size = _calc_chunksize(
-                dbs[source_col].find(query).count(), multi, chunk_size)
+            init_query = query
+            if incremental:
+                # Keep the chunks of earlier runs and only add chunks for keys
+                # past their end; with sampling, the last chunk runs to MaxKey
+                if reset or partition == 'sample':
+                    raise Exception("incremental can't be combined with reset " \
+                        "or sample partitioning")
+                init_query = _incremental_query(query, key, verbose)
+            count = dbs[source_col].find(init_query).count()
+            computed_chunk_size = _calc_chunksize(count, multi, chunk_size)
             if verbose & 2: print "chunk size:", computed_chunk_size
             if reset:
                 print >> sys.stderr, ("Dropping all records in destination db" +
                     "/collection {0}/{1}").format(dbd, dest.name)
                 dest.remove({})
-            _init(dbs[source_col], dest, key, query, computed_chunk_size, verbose)
+            if partition == 'exact':
+                _init(dbs[source_col], dest, key, init_query,
+                    computed_chunk_size, verbose, drop=not incremental)
+            elif partition == 'range':
+                _init_range(dbs[source_col], dest, key, init_query,
+                    computed_chunk_size, count, verbose, drop=not incremental)
+            elif partition == 'sample':
+                _init_sample(dbs[source_col], dest, key, query,
+                    computed_chunk_size, count, sample_size, verbose)
+            else:
+                raise Exception("Unknown partition mode %s" % partition)
         # Now process code, if one of the other "only_" options isn't turned on
         if not manage_only and not init_only:
             args = (init, cb, dbs[source_col], dest, query, key, sort, verbose,
                 sleep)
+            chunk_kwargs = {'rebalance': rebalance, 'batch': batch,
+                'write_queue': write_queue, 'prefetch': prefetch,
+                'write_bytes': write_bytes, 'write_count': write_count,
+                'write_mode': write_mode, 'write_concern': write_concern,
+                'ordered': ordered, 'threads': threads, 'inflight': inflight,
+                # Renew leases often enough that one late renewal doesn't
+                # get a live worker's chunk reopened
+                'heartbeat': heartbeat or timeout / 4.0,
+                'speculate': speculate, 'speculate_after': speculate_after,
+                'split': split, 'split_min': split_min, 'claim': claim,
+                'checkpoint': checkpoint, 'profile': profile,
+                'profile_dir': profile_dir, 'fields': fields, 'raw': raw,
+                'worker_init': worker_init if worker_init_each else None}
+            if checkpoint and write_mode in ('insert', 'inc'):
+                print >> sys.stderr, "WARNING -- resuming from a checkpoint " \
+                    "can write some output twice; use an upserting write_mode"
+            if split and sort != key:
+                print >> sys.stderr, "WARNING -- chunks can only be split " \
+                    "when sort is the same as key; not splitting"
             if verbose & 2:
-                print "Chunking with arguments %s" % (args,)
+                print "Chunking with arguments %s %s" % (args, chunk_kwargs)
             if is_shell():
                 print >> sys.stderr, ("WARNING -- can't generate module name. Multiprocessing will be emulated...")
-                do_chunks(*args)
+                do_chunks(*args, **chunk_kwargs)
             else:
                 if multi > 1:
                     for j in xrange(multi):
                         if verbose & 2:
                             print "Launching subprocess %s" % j
-                        proc = Process(target=do_chunks, args=args)
+                        proc = Process(target=do_chunks, args=args,
+                            kwargs=chunk_kwargs)
                         proc.start()
                 else:
-                    do_chunks(*args)
+                    do_chunks(*args, **chunk_kwargs)
             if wait_done:
-                manage(timeout, sleep)
+                manage(timeout, sleep, metrics_port, metrics_log,
+                    metrics_window, metrics_host)
                 #wait(timeout, verbose & 2)
     return dbd[dest_col]
 
-def toMongoEngine(pmobj, metype):
-    meobj = metype._from_son(pmobj)
-    meobj.validate()
-    return meobj
+def toMongoEngine(pmobj, metype, validate=None, fast=False):
+    """Converts pymongo document `pmobj` to an object of mongoengine class `metype`
+    @validate: validate the object; or, if a fraction, validate that fraction of
+objects, picked at random. By default, objects are validated unless `fast`.
+    @fast: return a light proxy for the class instead (see `_proxy_class`), or
+for the subclass named by the document's `_cls`; the document is only converted
+to a real mongoengine object when validated
+    """
+    if validate == None:
+        validate = not fast
+    if validate is True or (validate and random.random() < validate):
+        meobj = metype._from_son(pmobj)
+        meobj.validate()
+        if not fast:
+            return meobj
+    elif not fast:
+        return metype._from_son(pmobj)
+    if metype._meta.get('allow_inheritance'):
+        cls_name = pmobj.get('_cls')
+        if cls_name and cls_name != metype._class_name:
+            metype = get_document(cls_name)
+    return _proxy_class(metype)(pmobj)
+
+
+class _Proxy(object):
+    """Base class for the proxies built by `_proxy_class`
+    """
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return getattr(self, self._document._meta['id_field'])
+
+    def __repr__(self):
+        return "<%s proxy: %s>" % (self._document.__name__, self.to_mongo())
+
+
+_PROXIES = {}  # Proxy class for each mongoengine class
+_SERIALIZERS = {}  # Output serializer for each mongoengine class
+# Fields whose Python values are stored as they are
+_PLAIN_FIELDS = (meng.StringField, meng.IntField, meng.LongField,
+    meng.FloatField, meng.BooleanField, meng.DateTimeField, meng.ObjectIdField)
 
 
-def qmmapify(meng_class):
+def _proxy_class(meng_class):
+    """Returns a stand-in for mongoengine class `meng_class`, built on first use
+and cached: a class with a slot for each field, whose instances take the values
+straight from a pymongo document, without conversion or validation, and turn
+them back into one with `to_mongo`. Embedded documents and references stay in
+their pymongo form.
+    """
+    proxy = _PROXIES.get(meng_class)
+    if proxy != None:
+        return proxy
+    names = []
+    init = ["def __init__(self, son):", "    get = son.get"]
+    to_mongo = ["def to_mongo(self):", "    son = {}"]
+    env = {}
+    for i, (name, field) in enumerate(sorted(meng_class._fields.iteritems())):
+        names.append(name)
+        env['_d%d' % i] = field.default
+        if callable(field.default):
+            init.append("    self.%s = son[%r] if %r in son else _d%d()" % (
+                name, field.db_field, field.db_field, i))
+        else:
+            init.append("    self.%s = get(%r, _d%d)" % (name,
+                field.db_field, i))
+        to_mongo += ["    if self.%s is not None:" % name,
+            "        son[%r] = self.%s" % (field.db_field, name)]
+    if meng_class._meta.get('allow_inheritance'):
+        to_mongo.append("    son['_cls'] = %r" % meng_class._class_name)
+    to_mongo.append("    return son")
+    exec "\n".join(init + to_mongo) in env
+    proxy = type(meng_class.__name__ + "Proxy", (_Proxy,), {
+        '__slots__': tuple(names),
+        '__init__': env['__init__'],
+        'to_mongo': env['to_mongo'],
+        '_document': meng_class,
+    })
+    _PROXIES[meng_class] = proxy
+    return proxy
+
+
+def _to_mongo(obj):
+    """Converts an output of a mongoengine process function to pymongo: proxies
+and dicts as they are, and mongoengine objects field by field, with conversion
+only for fields that need it (see `_serializer`)
+    """
+    if isinstance(obj, _Proxy):
+        return obj.to_mongo()
+    if isinstance(obj, meng.Document) and not obj._dynamic:
+        return _serializer(type(obj))(obj)
+    if isinstance(obj, meng.base.BaseDocument):
+        return obj.to_mongo()
+    return obj
+
+
+def _serializer(meng_class):
+    """Returns a function converting objects of mongoengine class `meng_class` to
+pymongo documents, built on first use and cached; values of plain fields are
+copied as they are, and the rest converted by their field
+    """
+    ser = _SERIALIZERS.get(meng_class)
+    if ser != None:
+        return ser
+    plan = [(name, field.db_field,
+        None if type(field) in _PLAIN_FIELDS else field.to_mongo)
+        for name, field in meng_class._fields.iteritems()]
+    cls_name = meng_class._class_name \
+        if meng_class._meta.get('allow_inheritance') else None
+    def ser(obj):
+        data = obj._data
+        son = {}
+        for name, db_field, convert in plan:
+            value = data.get(name)
+            if value is not None:
+                son[db_field] = convert(value) if convert else value
+        if cls_name:
+            son['_cls'] = cls_name
+        return son
+    _SERIALIZERS[meng_class] = ser
+    return ser
+
+
+def qmmapify(meng_class, batch=False, validate=None, fast=False):
     """Decorator for turning a `process` function writeen for mongoengine objects,
 to a process function written for pymongo objects (and therefore compatible with
 QMmap.
     params:
     @meng_class: mongoengine class for the type that the mongoengine function
     expects as an argument
+    @batch: if True, the decorated function takes a list of mongoengine objects
+    and returns a list of outputs, for use with mmap's `batch` option
+    @validate: validate each input object, or, if a fraction, that fraction of
+    them; by default, all of them unless `fast` (see `toMongoEngine`)
+    @fast: pass the function light proxies of `meng_class` (see `_proxy_class`)
+    rather than mongoengine objects, and convert its output with a cached
+    serializer; the function may return proxies, mongoengine objects or dicts
     """
+    to_mongo = _to_mongo if fast else lambda obj: obj.to_mongo()
     def pymongo_process_fn(meng_process_fn):
         def wrapper(pymongo_source):
-            input_meng_obj = toMongoEngine(pymongo_source, meng_class)
+            input_meng_obj = toMongoEngine(pymongo_source, meng_class,
+                validate, fast)
             output_meng_obj = meng_process_fn(input_meng_obj)
             # If it returned an object at all, convert that to pymongo
             if output_meng_obj:
-                return output_meng_obj.to_mongo()
+                return to_mongo(output_meng_obj)
             else:
                 return None
-        return wrapper
+        def batch_wrapper(pymongo_sources):
+            input_meng_objs = [toMongoEngine(x, meng_class, validate, fast)
+                for x in pymongo_sources]
+            return [to_mongo(x) if x else None
+                for x in meng_process_fn(input_meng_objs)]
+        return batch_wrapper if batch else wrapper
     return pymongo_process_fn
 
 
@@ -430,25 +2135,172 @@ def connectMongoEngine(pmcol, conn_uri=None):
 def remaining():
     return housekeep.objects(state__ne = "done").count()
 
-def wait(timeout=120, verbose=True):
+def wait(timeout=120, verbose=True, sleep=1):
     t = time.time()
     r = remaining()
     rr = r
     while r:
 #         print "DEBUG r %f rr %f t %f" % (r, rr, time.time() - t)
         if time.time() - t > timeout:
-            if verbose: print >> sys.stderr, "TIMEOUT reached - resetting working chunks to open"
-            q = housekeep.objects(state = "working")
-            if q:
-                q.update(state="open", procname='none')
+            if verbose: print >> sys.stderr, "TIMEOUT reached - resetting chunks with expired leases to open"
+            _reopen_expired(timeout)
         if r != rr:
             t = time.time()
         if verbose: print r, "chunks remaning to be processed; %f seconds left until timeout" % (timeout - (time.time() - t)) 
-        time.sleep(1)
+        time.sleep(sleep)
         rr = r
         r = remaining()
 
 
+def _reopen_expired(timeout):
+    """Reopens, with a single update, every working chunk whose lease has gone
+`timeout` seconds without renewal; as the update checks each chunk's heartbeat,
+one renewed meanwhile stays with its worker
+    @return: number of chunks reopened
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout)
+    return _update_many(housekeep._get_collection(),
+        {'state': 'working', 'heartbeat': {'$lt': cutoff}},
+        {'$set': {'state': 'open', 'procname': 'none', 'backups': []}})
+
+
+def _status():
+    """Sums up the housekeeping collection with a single aggregation, grouping
+chunks by state and worker
+    @return: dict of the number of chunks in each state ('chunks'), the entries
+read so far ('entries') and in all ('entries_total'), write errors, the start
+of the oldest working chunk, the first and last finish times of done chunks,
+and for each worker ('workers') the entries read, chunks working and start of
+its oldest one (None while all of them are queued; see `_claim_chunks`)
+    """
+    done = {'$eq': ['$state', 'done']}
+    working = {'$eq': ['$state', 'working']}
+    rows = _aggregate(housekeep._get_collection(), [{'$group': {
+        # Done chunks only remember their worker in their stats
+        '_id': {'state': '$state',
+            'worker': {'$cond': [done, '$stats.worker', '$procname']}},
+        'chunks': {'$sum': 1},
+        'entries': {'$sum': {'$cond': [done, '$total',
+            {'$cond': [working, '$progress', 0]}]}},
+        'total': {'$sum': '$total'},
+        'write_errors': {'$sum': '$stats.write_errors'},
+        'tstart': {'$min': '$tstart'},
+        'first': {'$min': '$time'},
+        'last': {'$max': '$time'},
+    }}])
+    status = {'chunks': dict.fromkeys(('open', 'working', 'done'), 0),
+        'entries': 0, 'entries_total': 0, 'write_errors': 0,
+        'oldest_start': None, 'first_done': None, 'last_done': None,
+        'workers': {}}
+    for row in rows:
+        state = row['_id'].get('state') or 'open'
+        worker = row['_id'].get('worker')
+        status['chunks'][state] = status['chunks'].get(state, 0) + row['chunks']
+        status['entries'] += row['entries']
+        status['entries_total'] += row['total']
+        status['write_errors'] += row['write_errors']
+        if state == 'working' and row['tstart'] != None:
+            status['oldest_start'] = min(status['oldest_start'] or row['tstart'],
+                row['tstart'])
+        elif state == 'done':
+            status['first_done'] = min(status['first_done'] or row['first'],
+                row['first'])
+            status['last_done'] = max(status['last_done'] or row['last'],
+                row['last'])
+        if worker and state != 'open':
+            if worker not in status['workers']:
+                status['workers'][worker] = {'entries': 0, 'working': 0,
+                    'oldest_start': None}
+            w = status['workers'][worker]
+            w['entries'] += row['entries']
+            if state == 'working':
+                w['working'] += row['chunks']
+                w['oldest_start'] = row['tstart']
+    return status
+
+
+def merge_profiles(profile_dir='.', out=None, sort='cumulative', limit=30):
+    """Merges the per-chunk profiles dumped by workers run with `profile` (see
+`do_chunks`) into one report; for a multi-node job, gather each node's files
+into `profile_dir` first
+    @out: also dump the merged stats to this file, e.g. for a visualizer
+    @sort, limit: print the top `limit` functions by `sort`, as for
+pstats.Stats.sort_stats; no report if `limit` is 0
+    @return: the merged pstats.Stats
+    """
+    files = sorted(glob.glob(os.path.join(profile_dir, "*.prof")))
+    if not files:
+        raise Exception("No profiles found in %s" % profile_dir)
+    merged = pstats.Stats(*files)
+    if out:
+        merged.dump_stats(out)
+    if limit:
+        print "Merged %d chunk profiles from %s" % (len(files), profile_dir)
+        merged.sort_stats(sort).print_stats(limit)
+        sys.stdout.flush()
+    return merged
+
+
+def job_stats(source_col, dest_col, dest_uri="mongodb://127.0.0.1/test",
+        verbose=True):
+    """Sums up the stats recorded for each finished chunk of the job processing
+`source_col` into `dest_col` (see `_process`), to show whether it is bound by
+reading, processing or writing
+    @verbose: print a report as well
+    @return: dict of totals over the job, with per-worker totals in 'workers'
+    """
+    dbd = pymongo.MongoClient(dest_uri).get_default_database()
+    _connect(dbd[source_col], dbd[dest_col], dest_uri)
+    return _job_stats(verbose)
+
+
+def _job_stats(verbose=True):
+    """Sums up the stats recorded for each finished chunk in the housekeeping
+collection in use, as `job_stats` does
+    """
+    keys = ('total', 'write_errors', 't_read', 't_proc', 't_build', 't_write',
+        'bytes_read', 'bytes_written', 'elapsed')
+    job = dict.fromkeys(keys, 0)
+    job['chunks'] = 0
+    workers = {}
+    first = last = None
+    for hk in housekeep._get_collection().find(
+            {'state': 'done', 'stats': {'$exists': True}},
+            ['stats', 'tstart', 'time']):
+        st = hk['stats']
+        if not workers.get(st.get('worker')):
+            workers[st.get('worker')] = dict.fromkeys(keys + ('chunks',), 0)
+        for tot in (job, workers[st.get('worker')]):
+            tot['chunks'] += 1
+            for k in keys:
+                tot[k] += st.get(k, 0)
+        first = min(first or hk['tstart'], hk['tstart'])
+        last = max(last or hk['time'], hk['time'])
+    # Wall-clock time for the job, but time spent on chunks for each worker
+    job['elapsed'] = (last - first).total_seconds() if first else 0.0
+    job['rate'] = job['total'] / job['elapsed'] if job['elapsed'] else 0.0
+    for w in workers.itervalues():
+        w['rate'] = w['total'] / w['elapsed'] if w['elapsed'] else 0.0
+    job['workers'] = workers
+    if verbose:
+        print "%d chunks, %d entries in %.1f seconds (%.1f entries/sec); " \
+            "%d write errors" % (job['chunks'], job['total'], job['elapsed'],
+            job['rate'], job['write_errors'])
+        spent = sum(job[k] for k in ('t_read', 't_proc', 't_build', 't_write'))
+        if spent:
+            print "Time spent reading %.1f%%, processing %.1f%%, building " \
+                "writes %.1f%%, writing %.1f%%" % tuple(100. * job[k] / spent
+                for k in ('t_read', 't_proc', 't_build', 't_write'))
+        print "%d bytes read (estimated), %d bytes written" % (
+            job['bytes_read'], job['bytes_written'])
+        for name in sorted(workers):
+            w = workers[name]
+            print "%s: %d chunks, %d entries, %.1f entries/sec" % (name,
+                w['chunks'], w['total'], w['rate'])
+        sys.stdout.flush()
+    return job
+
+
 def _print_proc(log_str):
     """Utility function for writing to STDERR with procname prepended
     @log_str: string to write
@@ -459,16 +2311,15 @@ def _print_proc(log_str):
     sys.stderr.flush()
 
 
-def _print_progress():
-    q = housekeep.objects(state = 'done').only('time')
-    tot = housekeep.objects.count()
-    done = q.count()
+def _print_progress(status):
+    """Prints the progress of the job, from the result of `_status`
+    """
+    tot = sum(status['chunks'].itervalues())
+    done = status['chunks']['done']
     if done > 0:
         pdone = 100. * done / tot
-        q = q.order_by('time')
-        first = q[0].time
-        q = q.order_by('-time')
-        last = q[0].time
+        first = status['first_done']
+        last = status['last_done']
         if first and last:  # guard against lacking values
             tdone = float((last-first).seconds)
             ttot = tdone*tot / done
@@ -482,37 +2333,170 @@ def _print_progress():
 sys.stdout.flush()
 
 
-def manage(timeout, sleep=120):
+class _Metrics(object):
+    """Job metrics, updated from the job's status at each manager tick: chunks by
+state, entries read, write errors and the age of the oldest working chunk, with
+rates and ETA averaged over the samples of the last `window` seconds
+    """
+    def __init__(self, window=600):
+        self.window = window
+        self.samples = collections.deque()  # (time, entries, {worker: entries})
+        self.latest = {}
+
+    def update(self, status):
+        """Takes a new sample from `status`, the result of `_status`
+        @return: the latest metrics
+        """
+        tnow = datetime.datetime.utcnow()
+        entries = status['entries']
+        total = status['entries_total']
+        workers = dict((w, v['entries'])
+            for w, v in status['workers'].iteritems())
+        oldest = 0.0
+        if status['oldest_start']:
+            oldest = (tnow - status['oldest_start']).total_seconds()
+        t = time.time()
+        self.samples.append((t, entries, workers))
+        while len(self.samples) > 2 and t - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        t0, entries0, workers0 = self.samples[0]
+        span = t - t0
+        rate = max(0, entries - entries0) / span if span else 0.0
+        self.latest = {
+            'time': tnow.isoformat(),
+            'chunks': status['chunks'],
+            'entries': entries,
+            'entries_total': total,
+            'rate': rate,
+            'worker_rates': dict((w, max(0, n - workers0.get(w, 0)) / span
+                if span else 0.0) for w, n in workers.iteritems()),
+            'write_errors': status['write_errors'],
+            'oldest_working': oldest,
+            'eta': max(0, total - entries) / rate if rate else None,
+        }
+        return self.latest
+
+    def prometheus(self):
+        """Returns the latest metrics in the Prometheus text format
+        """
+        m = self.latest
+        if not m:
+            return ""
+        lines = ['# TYPE qmmap_chunks gauge']
+        lines += ['qmmap_chunks{state="%s"} %d' % (state, n)
+            for state, n in sorted(m['chunks'].iteritems())]
+        lines += [
+            '# TYPE qmmap_entries_read gauge',
+            'qmmap_entries_read %d' % m['entries'],
+            '# TYPE qmmap_entries_total gauge',
+            'qmmap_entries_total %d' % m['entries_total'],
+            '# TYPE qmmap_entries_per_second gauge',
+            'qmmap_entries_per_second %f' % m['rate'],
+            '# TYPE qmmap_worker_entries_per_second gauge',
+        ]
+        lines += ['qmmap_worker_entries_per_second{worker="%s"} %f' % (
+            w.strip().replace('"', '\\"'), r)
+            for w, r in sorted(m['worker_rates'].iteritems())]
+        lines += [
+            '# TYPE qmmap_write_errors gauge',
+            'qmmap_write_errors %d' % m['write_errors'],
+            '# TYPE qmmap_oldest_working_seconds gauge',
+            'qmmap_oldest_working_seconds %f' % m['oldest_working'],
+        ]
+        if m['eta'] != None:
+            lines += ['# TYPE qmmap_eta_seconds gauge',
+                'qmmap_eta_seconds %f' % m['eta']]
+        return "\n".join(lines) + "\n"
+
+
+def _serve_metrics(metrics, port, host='127.0.0.1'):
+    """Serves the latest `metrics` in the Prometheus text format on `port` of
+interface `host`, from a background thread
+    @return: the HTTP server
+    """
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Don't log every scrape
+    server = BaseHTTPServer.HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _manage_step(timeout):
+    """One status update of `manage`: reopens chunks whose worker hasn't renewed
+its lease within `timeout` seconds, then takes stock, with one round trip each,
+and prints the job's progress and each worker's
+    @return: the job's status, from `_status`
+    """
+    reopened = _reopen_expired(timeout)
+    if reopened:
+        print (u"No heartbeat for more than {0} sec on {1} chunks;" +
+            u" setting status back to open").format(timeout, reopened)
+    status = _status()
+    _print_progress(status)
+    tnow = datetime.datetime.utcnow()  # get time once instead of repeating
+    for worker in sorted(status['workers']):
+        w = status['workers'][worker]
+        if not w['working']:
+            continue
+        if w['oldest_start'] == None:  # only queued chunks, none started yet
+            print u"Worker {0} on {1} chunks, none started yet; {2} entries " \
+                u"read".format(worker.strip(), w['working'], w['entries'])
+        else:
+            print (u"Worker {0} on {1} chunks, the oldest working for {2} " +
+                u"sec; {3} entries read").format(worker.strip(),
+                w['working'], (tnow - w['oldest_start']).total_seconds(),
+                w['entries'])
+    sys.stdout.flush()
+    return status
+
+
+def manage(timeout, sleep=120, metrics_port=None, metrics_log=None,
+        metrics_window=600, metrics_host='127.0.0.1'):
     """Give periodic status, reopen dead jobs, return success when over;
     combination of wait, status, clean, and the reprocessing functions.
     sleep = time (sec) between status updates
-    timeout = time (sec) to give a job until it's restarted
+    timeout = time (sec) a job's lease lasts without a heartbeat from its
+    worker before it's restarted
+    metrics_port = if set, serve job metrics for Prometheus on this port
+    metrics_log = if set, append job metrics to this file at each status
+    update, as a line of JSON
+    metrics_window = time (sec) over which rates and ETA are averaged
+    metrics_host = interface to serve metrics on; only this machine can scrape
+    them by default, and '' serves them on all interfaces
     """
-    num_not_done = _num_not_at_state('done')
+    status = _status()
+    num_not_done = sum(status['chunks'].itervalues()) - status['chunks']['done']
     print "Managing job's execution; currently {0} remaining".format(num_not_done)
     sys.stdout.flush()
+    metrics = server = None
+    if metrics_port or metrics_log:
+        metrics = _Metrics(metrics_window)
+        metrics.update(status)
+    if metrics_port:
+        server = _serve_metrics(metrics, metrics_port, metrics_host)
     # Keep going until none are state=working or done
-    while _num_not_at_state('done') > 0:
+    while num_not_done > 0:
         # Sleep before management step
         time.sleep(sleep)
-        _print_progress()
-        # Now, iterate over state=working jobs, restart ones that have gone
-        # on longer than the timeout param
-        tnow = datetime.datetime.utcnow()  # get time once instead of repeating
-        # Iterate through working objects to see if it's too long
-        hkwquery = [h for h in housekeep.objects(state='working').all()]
-        for hkw in hkwquery:
-            # .tstart must have time value for state to equal 'working' at all
-            time_taken = (tnow - hkw.tstart).total_seconds()
-            print (u"Chunk on {0} starting at {1} has been working for {2} " +
-                u"sec").format(hkw.procname, hkw.start, time_taken)
-            sys.stdout.flush()
-            if time_taken > timeout:
-                print (u"More than {0} sec spent on chunk {1} ;" +
-                    u" setting status back to open").format(
-                    timeout, hkw.start)
-                sys.stdout.flush()
-                hkw.state = "open"
-                hkw.procname = 'none'
-                hkw.save()
+        status = _manage_step(timeout)
+        num_not_done = sum(status['chunks'].itervalues()) - \
+            status['chunks']['done']
+        if metrics:
+            m = metrics.update(status)
+            if metrics_log:
+                with open(metrics_log, "a") as f:
+                    f.write(json.dumps(m) + "\n")
+    if server:
+        server.shutdown()
     print "----------- PROCESSING COMPLETED ------------"
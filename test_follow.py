@@ -0,0 +1,46 @@
+# Needs a single-node replica set, e.g.
+#   mongod --replSet rs0 --dbpath /tmp/rs0
+#   mongo --eval "rs.initiate()"
+
+def process(source):
+    print "  followed %s" % source['_id']
+    return {'_id': source['_id'], 'val': source['num'] * 10}
+
+def follow(uri):
+    """Follow qmmap_src into qmmap_dest in a separate process"""
+    from multiprocessing import Process
+    follower = Process(target=qmmap.mmap, args=(process, "qmmap_src",
+        "qmmap_dest"), kwargs={'source_uri': uri, 'dest_uri': uri,
+        'follow': True, 'verbose': 3})
+    follower.start()
+    return follower
+
+if __name__ == "__main__":
+    import pymongo, qmmap, time
+
+    uri = "mongodb://127.0.0.1/test?replicaSet=rs0"
+    db = pymongo.MongoClient(uri).get_default_database()
+
+    if raw_input("drop qmmap_src, qmmap_dest, follow state(qmmap_src_qmmap_dest_follow)?")[:1] == 'y':
+        db.qmmap_src.drop()
+        db.qmmap_dest.drop()
+        db.qmmap_src_qmmap_dest_follow.drop()
+
+    follower = follow(uri)
+    time.sleep(3)
+    for i in range(10):
+        db.qmmap_src.save({'_id': i, 'num': i})
+    db.qmmap_src.update({'_id': 0}, {'$set': {'num': 100}})
+    time.sleep(5)
+    follower.terminate()
+    print "output:", list(db.qmmap_dest.find().sort('_id'))
+
+    # Changes made while no one is following are picked up on restart
+    for i in range(10, 15):
+        db.qmmap_src.save({'_id': i, 'num': i})
+    follower = follow(uri)
+    time.sleep(5)
+    follower.terminate()
+    print "after restart: %d documents (expected 15), _id 0 val %s " \
+        "(expected 1000)" % (db.qmmap_dest.count(),
+        db.qmmap_dest.find_one({'_id': 0})['val'])
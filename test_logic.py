@@ -0,0 +1,536 @@
+# Checks of qmmap's internal logic that need no MongoDB server; run with
+#   python test_logic.py
+import sys, datetime, time
+import bson, pymongo
+import mongoengine as meng
+from mongoengine.context_managers import switch_collection
+import qmmap
+
+class Skip(Exception):
+    """Raised by a check that can't run here"""
+
+class FakeCursor(list):
+    """Stands in for the sorted key-only cursor that `_init` reads"""
+    def sort(self, *args):
+        return self
+    def batch_size(self, n):
+        return self
+
+class FakeCollection(object):
+    def __init__(self, keys):
+        self.keys = keys
+    def find(self, query, fields):
+        return FakeCursor({'_id': k} for k in sorted(self.keys))
+
+def chunks_for(keys, chunk_size):
+    """Runs `_init` over `keys`, returning the (start, end, total) of each chunk"""
+    records = []
+    insert = qmmap._insert_housekeep
+    qmmap._insert_housekeep = records.extend
+    try:
+        qmmap._init(FakeCollection(keys), None, '_id', {}, chunk_size, 0,
+            drop=False)
+    finally:
+        qmmap._insert_housekeep = insert
+    return [(r['_id'], r['end'], r['total']) for r in records]
+
+def test_init_boundaries():
+    assert chunks_for(range(10), 4) == [(0, 3, 4), (4, 7, 4), (8, 9, 2)]
+    # Equal keys are never split across chunks, even past chunk_size
+    keys = [1, 1, 1, 1, 1, 2, 3, 3, 3, 4]
+    assert chunks_for(keys, 2) == [(1, 1, 5), (2, 3, 4), (4, 4, 1)]
+    assert chunks_for([], 3) == []
+
+def test_range_points():
+    assert qmmap._range_points(0, 100, 4) == [25, 50, 75]
+    # Never more points than there are distinct values in between
+    assert qmmap._range_points(0, 3, 10) == [1, 2]
+    assert qmmap._range_points(5, 6, 2) == []
+    lo = bson.ObjectId.from_datetime(datetime.datetime(2020, 1, 1))
+    hi = bson.ObjectId.from_datetime(datetime.datetime(2021, 1, 1))
+    points = qmmap._range_points(lo, hi, 4)
+    assert len(points) == 3 and lo < points[0] < points[1] < points[2] < hi
+    d = datetime.datetime(2020, 5, 6, 7, 8, 9, 123000)
+    assert qmmap._num_to_key(qmmap._key_to_num(d), d) == d
+    try:
+        qmmap._key_to_num(u'abc')
+        assert False, "strings have no arithmetic"
+    except ValueError:
+        pass
+
+def rebalanced(setup=None):
+    """Claims a chunk [0, 100) estimated at 10 entries, of 100, and rebalances it
+to at most twice that, after running `setup`
+    @return: (start, end, state) of each chunk
+    """
+    col = mock_housekeeping()
+    db = qmmap.housekeep._get_db()
+    for i in range(100):
+        db.qmmap_src.insert({'_id': i})
+    qmmap._insert_housekeep([qmmap.housekeep(start=0, end=100, total=10,
+        end_exclusive=True, estimated=True).to_mongo()])
+    hko = qmmap.housekeep._from_son(qmmap._claim_chunks(1)[0])
+    if setup:
+        setup(col)
+    qmmap._rebalance(db.qmmap_src, {}, '_id', hko, 2.0, 0)
+    return [(c['_id'], c['end'], c['state'])
+        for c in col.find().sort('_id', pymongo.ASCENDING)]
+
+def test_rebalance():
+    assert rebalanced() == [(0, 12, 'working'), (12, 25, 'open'),
+        (25, 50, 'open'), (50, 100, 'open')]
+    # A chunk already at the split point stops the rebalancing
+    def split_before(col):
+        col.insert({'_id': 50, 'end': 100, 'state': 'done'})
+    assert rebalanced(split_before) == [(0, 100, 'working'), (50, 100, 'done')]
+    # So does losing the chunk, giving back the half split off
+    def lose(col):
+        col.update({'_id': 0}, {'$set': {'procname': 'other'}})
+    assert rebalanced(lose) == [(0, 100, 'working')]
+
+def test_call_batch():
+    double = lambda docs: [d * 2 for d in docs]
+    assert qmmap._call_batch(double, [1, 2, 3]) == [(1, 2), (2, 4), (3, 6)]
+    def picky(docs):
+        if 3 in docs:
+            raise ValueError("no threes")
+        return [d * 2 for d in docs]
+    pairs = qmmap._call_batch(picky, [1, 2, 3])
+    assert pairs[:2] == [(1, 2), (2, 4)] and pairs[2] == (3, qmmap._FAILED)
+    # The wrong number of outputs also retries one by one
+    assert qmmap._call_batch(lambda docs: docs[:1], [1, 2]) == [(1, 1), (2, 2)]
+
+def test_results_threads():
+    def slow(doc):
+        time.sleep(0.02 if doc % 3 else 0.05)
+        return doc * 10
+    pairs = list(qmmap._results(slow, iter(range(50)), threads=4))
+    assert pairs == [(d, d * 10) for d in range(50)]
+    pairs = list(qmmap._results(slow, iter(range(50)), threads=4,
+        in_order=False))
+    assert sorted(pairs) == [(d, d * 10) for d in range(50)]
+
+class ChangeStream(object):
+    """Stands in for a change stream returning `events`, and then None; without
+`try_next` if `polled` is False, like pymongo before 3.8
+    """
+    def __init__(self, events, polled=True):
+        self.events = list(events)
+        if polled:
+            self.try_next = lambda: self.events.pop(0) if self.events else None
+    def next(self):  # waits for a change
+        return self.events.pop(0)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        pass
+
+class WatchedCollection(object):
+    def __init__(self, stream):
+        self.stream = stream
+    def watch(self, *args, **kwargs):
+        return self.stream
+
+def test_change_events():
+    events = [{'_id': 't1', 'fullDocument': {'_id': 1}},
+        {'_id': 't2', 'fullDocument': None}, None,
+        {'_id': 't3', 'fullDocument': {'_id': 3}}]
+    col = WatchedCollection(ChangeStream(events))
+    changes = qmmap._change_events(col, {}, None, 0)
+    # Deleted documents are skipped, and a quiet stream gives (None, None)
+    assert [next(changes) for i in range(4)] == [({'_id': 1}, 't1'),
+        (None, None), ({'_id': 3}, 't3'), (None, None)]
+    # A stream that can't be polled falls back to the oplog
+    tail = qmmap._tail_oplog
+    qmmap._tail_oplog = lambda src_col, query, resume: iter([('oplog', None)])
+    try:
+        col = WatchedCollection(ChangeStream(events, polled=False))
+        assert list(qmmap._change_events(col, {}, None, 0)) == \
+            [('oplog', None)]
+    finally:
+        qmmap._tail_oplog = tail
+
+def mock_housekeeping():
+    """Points mongoengine, and so the housekeeping collection, at an empty
+in-memory mongomock database; checks that need one are skipped without mongomock
+    @return: the housekeeping collection
+    """
+    try:
+        import mongomock.read_preferences
+    except ImportError:
+        raise Skip("needs mongomock")
+    meng.connection.disconnect()
+    meng.connect('qmmap_test', host='mongomock://localhost',
+        read_preference=mongomock.read_preferences.PRIMARY)
+    switch_collection(qmmap.housekeep, 'qmmap_test_hk').__enter__()
+    qmmap.housekeep.drop_collection()
+    return qmmap.housekeep._get_collection()
+
+def add_chunks(n, **fields):
+    qmmap._insert_housekeep([qmmap.housekeep(start=i, end=i, total=10,
+        **fields).to_mongo() for i in range(n)])
+
+def ago(seconds):
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds)
+
+def test_lease_renewal():
+    col = mock_housekeeping()
+    add_chunks(3)
+    start = qmmap._claim_chunks(1)[0]['_id']
+    assert qmmap._renew_lease(start, progress=5)
+    assert col.find_one({'_id': start})['progress'] == 5
+    # Only leases that went without a renewal for the timeout are reopened,
+    # after which the worker's next renewal fails
+    assert qmmap._reopen_expired(30) == 0
+    col.update({'_id': start}, {'$set': {'heartbeat': ago(60)}})
+    assert qmmap._reopen_expired(30) == 1
+    assert col.find_one({'_id': start})['state'] == 'open'
+    assert not qmmap._renew_lease(start, progress=6)
+
+def test_claim_backup():
+    col = mock_housekeeping()
+    add_chunks(3, state='working', procname='other', progress=4)
+    col.update({'_id': 0}, {'$set': {'tstart': ago(10)}})
+    col.update({'_id': 1}, {'$set': {'tstart': ago(60)}})
+    col.update({'_id': 2}, {'$set': {'tstart': ago(90), 'backups': ['third']}})
+    # The longest-running chunk old enough and with room for another backup
+    assert qmmap._claim_backup(1, 30)['_id'] == 1
+    assert qmmap._claim_backup(1, 30) == None
+    assert qmmap._claim_backup(2, 30)['_id'] == 2
+    # A backup keeps the lease alive without touching the worker's progress,
+    # and the first copy to finish wins
+    assert qmmap._renew_lease(1, progress=9)
+    assert col.find_one({'_id': 1})['progress'] == 4
+    assert qmmap._finish_chunk(1, 10)
+    chunk = col.find_one({'_id': 1})
+    assert chunk['state'] == 'done' and chunk['backups'] == []
+    assert not qmmap._finish_chunk(1, 10)
+
+def test_request_split():
+    col = mock_housekeeping()
+    db = qmmap.housekeep._get_db()
+    for i in range(100):
+        db.qmmap_src.insert({'_id': i, 'keep': i <= 40})
+    add_chunks(1, state='working', procname='other', tstart=ago(60), position=10,
+        progress=10)
+    col.update({'_id': 0}, {'$set': {'end': 99, 'total': 100}})
+    # The split point is past the middle of the keys left that match the query
+    assert not qmmap._request_split(db.qmmap_src, {'keep': True}, '_id', 100, 0)
+    assert qmmap._request_split(db.qmmap_src, {'keep': True}, '_id', 50, 0)
+    chunk = col.find_one({'_id': 0})
+    assert chunk['split_at'] == 25 and chunk['split_total'] == 45, chunk
+    # Only once per chunk
+    assert not qmmap._request_split(db.qmmap_src, {'keep': True}, '_id', 50, 0)
+
+def fill_missing(col):
+    """Gives every chunk the fields `_status` groups on; mongomock, unlike
+MongoDB, can't group on missing fields
+    """
+    for chunk in col.find():
+        stats = dict({'worker': chunk['procname'], 'write_errors': 0},
+            **chunk.get('stats') or {})
+        col.update({'_id': chunk['_id']}, {'$set': {'stats': stats,
+            'time': chunk.get('time'), 'tstart': chunk.get('tstart')}})
+
+def test_manage_queued_chunks():
+    col = mock_housekeeping()
+    add_chunks(6)
+    claimed = qmmap._claim_chunks(3)
+    assert len(claimed) == 3
+    assert all(c['tstart'] == None for c in claimed)
+    fill_missing(col)
+    # A worker whose chunks are all queued has no oldest start
+    status = qmmap._manage_step(60)
+    assert status['chunks'] == {'open': 3, 'working': 3, 'done': 0}
+    assert status['workers'][qmmap.procname()]['oldest_start'] == None
+    assert qmmap._start_chunk(claimed[0]['_id'])
+    status = qmmap._manage_step(60)
+    assert status['workers'][qmmap.procname()]['oldest_start'] != None
+
+def checkpoint_after(values, write_count):
+    """Processes one chunk of documents with the dotted field 'a.b' set to each of
+`values`, in that order, checkpointing on it
+    @return: the chunk's checkpoint
+    """
+    col = mock_housekeeping()
+    db = qmmap.housekeep._get_db()
+    for i, value in enumerate(values):
+        db.qmmap_src.insert({'_id': i, 'a': {'b': value}})
+    add_chunks(1)
+    start = qmmap._claim_chunks(1)[0]['_id']
+    cursor = db.qmmap_src.find().sort('a.b', pymongo.ASCENDING)
+    qmmap._process(None, lambda doc: {'_id': doc['_id'], 'x': 1}, cursor,
+        db.qmmap_dest, 0, hkstart=start, checkpoint='a.b',
+        write_count=write_count)
+    assert db.qmmap_dest.count() == len(values)
+    return col.find_one({'_id': start})['checkpoint']
+
+def test_checkpoint_values():
+    mark = checkpoint_after([None, None, 1, 1, 2, 2, 3, 3, 4, 4], 3)
+    assert mark == {'value': 3, 'good': 8, 'seen': 8}, mark
+    # No checkpoint to resume after a missing value
+    assert checkpoint_after([None] * 6, 2) == {}
+
+def test_job_stats():
+    col = mock_housekeeping()
+    add_chunks(4)
+    t = datetime.datetime(2020, 1, 1)
+    for i, worker, seconds in ((0, 'a', 10), (1, 'a', 20), (2, 'b', 40)):
+        col.update({'_id': i}, {'$set': {'state': 'done',
+            'tstart': t + datetime.timedelta(seconds=seconds - 10),
+            'time': t + datetime.timedelta(seconds=seconds),
+            'stats': {'worker': worker, 'total': 10, 't_read': 1.0,
+                't_proc': 3.0, 'write_errors': i, 'elapsed': 10.0}}})
+    job = qmmap._job_stats(verbose=False)
+    # The open chunk has no stats yet
+    assert job['chunks'] == 3 and job['total'] == 30
+    assert job['t_read'] == 3.0 and job['t_proc'] == 9.0
+    assert job['write_errors'] == 3
+    # Wall-clock time for the job, but time spent on chunks for each worker
+    assert job['elapsed'] == 40.0 and job['rate'] == 0.75
+    assert job['workers']['a']['chunks'] == 2
+    assert job['workers']['a']['rate'] == 1.0
+    assert job['workers']['b']['total'] == 10
+
+def test_process_stats():
+    mock_housekeeping()
+    db = qmmap.housekeep._get_db()
+    for i in range(5):
+        db.qmmap_src.insert({'_id': i})
+    stats = {}
+    qmmap._process(None, lambda doc: {'_id': doc['_id'], 'x': 1},
+        db.qmmap_src.find(), db.qmmap_dest, 0, stats=stats)
+    assert stats['total'] == 5 and stats['write_errors'] == 0
+    assert stats['worker'] == qmmap.procname() and stats['bytes_written'] > 0
+    for k in ('t_read', 't_proc', 't_build', 't_write', 'elapsed', 'rate'):
+        assert stats[k] >= 0, k
+
+def job_status(entries, worker_entries, oldest_start=None):
+    return {'chunks': {'open': 2, 'working': 1, 'done': 3}, 'entries': entries,
+        'entries_total': 1000, 'write_errors': 1, 'oldest_start': oldest_start,
+        'workers': dict((w, {'entries': n, 'working': 1, 'oldest_start': None})
+            for w, n in worker_entries.items())}
+
+def test_metrics():
+    metrics = qmmap._Metrics(window=15)
+    metrics.update(job_status(0, {}))
+    metrics.update(job_status(100, {'a': 100}))
+    m = metrics.update(job_status(300, {'a': 200, 'b "x"': 100}, ago(30)))
+    assert m['entries'] == 300 and m['chunks']['done'] == 3
+    assert 29 < m['oldest_working'] < 31 and m['eta'] > 0
+    # Space the samples 10 seconds apart, so that rates are averaged over the
+    # last 20 seconds: the oldest sample is dropped, being past `window`
+    t = time.time()
+    for i, seconds in enumerate((30, 20, 10)):
+        metrics.samples[i] = (t - seconds,) + metrics.samples[i][1:]
+    m = metrics.update(job_status(500, {'a': 300, 'b "x"': 200}))
+    assert len(metrics.samples) == 3
+    assert abs(m['rate'] - 20) < 0.1, m['rate']
+    assert abs(m['worker_rates']['a'] - 10) < 0.1
+    assert abs(m['eta'] - 25) < 0.5, m['eta']
+    text = metrics.prometheus()
+    assert 'qmmap_chunks{state="open"} 2\n' in text
+    assert 'qmmap_entries_read 500\n' in text
+    assert 'qmmap_worker_entries_per_second{worker="b \\"x\\""}' in text
+    assert 'qmmap_oldest_working_seconds 0.000000\n' in text
+    assert qmmap._Metrics().prometheus() == ""
+
+def test_serve_metrics():
+    import urllib2
+    metrics = qmmap._Metrics()
+    metrics.update(job_status(10, {}))
+    # Only on the loopback interface unless asked for another
+    server = qmmap._serve_metrics(metrics, 0)
+    try:
+        host, port = server.server_address
+        assert host == '127.0.0.1'
+        body = urllib2.urlopen('http://127.0.0.1:%d/metrics' % port).read()
+        assert body == metrics.prometheus()
+    finally:
+        server.shutdown()
+
+def test_status():
+    col = mock_housekeeping()
+    add_chunks(6)
+    t = datetime.datetime(2020, 1, 1)
+    for i, state, worker, progress in ((1, 'working', 'a', 4),
+            (2, 'working', 'a', 3), (3, 'working', 'b', 0)):
+        col.update({'_id': i}, {'$set': {'state': state, 'procname': worker,
+            'progress': progress,
+            'tstart': t + datetime.timedelta(seconds=i) if i < 3 else None}})
+    for i, worker, errors in ((4, 'a', 1), (5, 'c', 2)):
+        col.update({'_id': i}, {'$set': {'state': 'done',
+            'time': t + datetime.timedelta(seconds=10 * i),
+            'stats': {'worker': worker, 'write_errors': errors}}})
+    fill_missing(col)
+    status = qmmap._status()
+    assert status['chunks'] == {'open': 1, 'working': 3, 'done': 2}
+    assert status['entries'] == 4 + 3 + 10 + 10
+    assert status['entries_total'] == 60 and status['write_errors'] == 3
+    assert status['oldest_start'] == t + datetime.timedelta(seconds=1)
+    assert status['first_done'] == t + datetime.timedelta(seconds=40)
+    assert status['last_done'] == t + datetime.timedelta(seconds=50)
+    workers = status['workers']
+    assert sorted(workers) == ['a', 'b', 'c']
+    assert workers['a'] == {'entries': 17, 'working': 2,
+        'oldest_start': t + datetime.timedelta(seconds=1)}
+    assert workers['b']['oldest_start'] == None
+    assert workers['c'] == {'entries': 10, 'working': 0, 'oldest_start': None}
+
+def test_raw_id():
+    if qmmap.RawBSONDocument == None:
+        raise Skip("needs pymongo 3.2 or later")
+    for _id in (bson.ObjectId(), 5, 2 ** 40, 1.5, u'h\xe9llo'):
+        raw = qmmap.RawBSONDocument(bson.BSON.encode({'a': 1, '_id': _id}))
+        assert qmmap._raw_id(raw) == (True, _id)
+    raw = qmmap.RawBSONDocument(bson.BSON.encode({'a': 1}))
+    assert qmmap._raw_id(raw) == (False, None)
+
+def test_bulk_writer_sizes():
+    dest = pymongo.MongoClient(connect=False).test.qmmap_dest
+    doc = dict(('f%d' % i, i) for i in range(50))
+    for mode in ('insert', 'set', 'replace', 'inc'):
+        writer = qmmap._BulkWriter(dest, max_bytes=4000, mode=mode)
+        full = [writer.add(dict(doc, _id=i)) for i in range(20)]
+        size = qmmap._doc_size(dict(doc, _id=0))
+        # Sizes are exact when encoded, and estimated otherwise; either way
+        # the op fills up once the bytes pass max_bytes
+        assert abs(writer.size - 20 * size) <= 20 * 4, (mode, writer.size)
+        assert full.index(True) == 4000 // size, mode
+        assert writer.count == 20
+    writer = qmmap._BulkWriter(dest, max_count=5)
+    assert [writer.add({'_id': i}) for i in range(5)][-1]
+
+class qmmap_base(meng.Document):
+    meta = {'allow_inheritance': True}
+    s = meng.StringField()
+    n = meng.IntField(default=3)
+    tags = meng.ListField(meng.StringField())
+
+class qmmap_sub(qmmap_base):
+    extra = meng.StringField()
+
+def test_proxy_round_trip():
+    son = {'_id': bson.ObjectId(), '_cls': 'qmmap_base', 's': 'x',
+        'tags': ['a']}
+    obj = qmmap.toMongoEngine(son, qmmap_base, validate=False, fast=True)
+    assert obj.s == 'x' and obj.n == 3 and obj.pk == son['_id']
+    obj.s = 'y'
+    assert obj.to_mongo() == dict(son, s='y', n=3)
+    # A subclass document keeps its class and fields
+    son = {'_id': bson.ObjectId(), '_cls': 'qmmap_base.qmmap_sub', 's': 'x',
+        'extra': 'zz'}
+    obj = qmmap.toMongoEngine(son, qmmap_base, validate=True, fast=True)
+    assert obj.to_mongo() == dict(son, n=3, tags=[])
+    # Mongoengine objects go through the cached serializer
+    out = qmmap._to_mongo(qmmap_sub(s='q', extra='e', tags=['t']))
+    assert out == {'_cls': 'qmmap_base.qmmap_sub', 's': 'q', 'n': 3,
+        'tags': ['t'], 'extra': 'e'}, out
+
+def test_fast_skips_validation():
+    son = {'_id': bson.ObjectId(), '_cls': 'qmmap_base', 'n': 'not a number'}
+    # Fast proxies aren't validated unless asked
+    assert qmmap.toMongoEngine(son, qmmap_base, fast=True).n == 'not a number'
+    for kwargs in ({}, {'fast': True, 'validate': True}):
+        try:
+            qmmap.toMongoEngine(son, qmmap_base, **kwargs)
+            assert False, "should fail validation"
+        except meng.ValidationError:
+            pass
+
+class LookupCollection(object):
+    """Stands in for a collection looked up by _id, counting the queries made;
+`find` raises while `down` is set
+    """
+    def __init__(self, docs):
+        self.docs = dict((d['_id'], d) for d in docs)
+        self.finds = self.find_ones = 0
+        self.down = False
+    def find(self, query, projection):
+        self.finds += 1
+        if self.down:
+            raise pymongo.errors.AutoReconnect("connection lost")
+        return [self.docs[v] for v in query['_id']['$in'] if v in self.docs]
+    def find_one(self, query, projection):
+        self.find_ones += 1
+        return self.docs.get(query['_id'])
+
+def test_lookup_cache():
+    col = LookupCollection({'_id': i, 'x': i * 2} for i in range(10))
+    lk = qmmap._Lookup(col, 'ref', cache_size=3)
+    lk.prefetch([{'ref': 1}, {'ref': [2, 12]}, {'ref': None}, {}])
+    assert col.finds == 1 and len(lk.cache) == 3
+    # Values with no document are cached too
+    assert lk.get(1) == {'_id': 1, 'x': 2} and lk.get(12) == None
+    lk.prefetch([{'ref': 1}, {'ref': 12}])
+    assert col.finds == 1 and col.find_ones == 0
+    # The least recently used entry makes room for a new one
+    assert lk.get(4) == {'_id': 4, 'x': 8} and col.find_ones == 1
+    assert sorted(lk.cache) == [1, 4, 12]
+    assert lk.counts() == {'hits': 2, 'misses': 1, 'queries': 2, 'cached': 3}
+
+def test_lookup_prefetch_failure():
+    col = LookupCollection({'_id': i} for i in range(10))
+    lk = qmmap.declare_lookup('qmmap_test', col, 'ref')
+    assert qmmap.declare_lookup('qmmap_test', col, 'ref') is lk
+    col.down = True
+    # A failed prefetch leaves the values to be looked up one by one
+    lk.prefetch([{'ref': 5}, {'ref': 6}])
+    assert lk.counts()['queries'] == 0 and not lk.cache
+    assert qmmap.lookup('qmmap_test', 5) == {'_id': 5}
+    assert qmmap.lookup_stats()['qmmap_test'] == {'hits': 0, 'misses': 1,
+        'queries': 1, 'cached': 1}
+
+class Done(object):
+    """A future that has already finished with `value`"""
+    def __init__(self, value):
+        self.value = value
+    def result(self):
+        return self.value
+
+def test_worker_init():
+    calls = []
+    def init(src, dest):
+        calls.append((src, dest))
+        return {'table': [1, 2, 3]}
+    assert qmmap._run_worker_init(init, 'src', 'dest', verbose=0) == \
+        {'table': [1, 2, 3]}
+    assert qmmap.worker_context == {'table': [1, 2, 3]}
+    assert calls == [('src', 'dest')]
+    # Futures are waited on, and nothing returned leaves an empty context
+    qmmap._run_worker_init(lambda src, dest: Done(7), None, None, verbose=0)
+    assert qmmap.worker_context == 7
+    qmmap._run_worker_init(lambda src, dest: None, None, None, verbose=0)
+    assert qmmap.worker_context == {}
+
+def test_shared_array():
+    try:
+        import numpy
+    except ImportError:
+        raise Skip("needs numpy")
+    import multiprocessing
+    arr = qmmap.shared_array((2, 3), 'int32')
+    assert arr.shape == (2, 3) and arr.dtype == numpy.int32 and not arr.any()
+    def fill(i):
+        arr[i] = i + 1
+    # Writes by forked workers are seen by the parent
+    procs = [multiprocessing.Process(target=fill, args=(i,)) for i in range(2)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert arr.tolist() == [[1, 1, 1], [2, 2, 2]]
+
+if __name__ == "__main__":
+    failed = 0
+    for name, fn in sorted(globals().items()):
+        if name.startswith('test_') and callable(fn):
+            try:
+                fn()
+                print "ok    ", name
+            except Skip as e:
+                print "skip  ", name, e
+            except Exception as e:
+                failed += 1
+                print "FAILED", name, repr(e)
+    sys.exit(1 if failed else 0)
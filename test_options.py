@@ -0,0 +1,73 @@
+# Runs small jobs with each of mmap's main options against a local mongod, and
+# checks their output; run with
+#   python test_options.py [num]
+import sys
+import qmmap
+
+def process(source):
+    return {'_id': source['_id'], 'val': source['num'] * 10}
+
+def process_batch(sources):
+    return [process(s) for s in sources]
+
+def process_inc(source):
+    return {'_id': source['_id'], 'val': 1}
+
+# Each case: name, processing function, mmap options, and the expected `val`
+# of the output for input document number i (run twice for 'inc')
+CASES = [
+    ("partition exact", process, {'partition': 'exact'}, lambda i: i * 10),
+    ("partition range", process, {'partition': 'range', 'rebalance': 2.0},
+        lambda i: i * 10),
+    ("partition sample", process, {'partition': 'sample', 'sample_size': 50},
+        lambda i: i * 10),
+    ("batch", process_batch, {'batch': 7}, lambda i: i * 10),
+    ("no housekeeping", process, {'multi': None}, lambda i: i * 10),
+    ("write_mode insert", process, {'write_mode': 'insert', 'reset': True},
+        lambda i: i * 10),
+    ("write_mode replace", process, {'write_mode': 'replace'},
+        lambda i: i * 10),
+    ("write_mode inc", process_inc, {'write_mode': 'inc'}, lambda i: 2),
+    ("threads", process, {'threads': 4}, lambda i: i * 10),
+    ("split", process, {'split': True, 'split_min': 10, 'chunk_size': 200},
+        lambda i: i * 10),
+    ("claim", process, {'claim': 4}, lambda i: i * 10),
+    ("checkpoint", process, {'checkpoint': True, 'write_count': 10},
+        lambda i: i * 10),
+]
+
+def run_case(db, name, fn, options, expected, num):
+    db.qmmap_dest.drop()
+    db.qmmap_src_qmmap_dest.drop()
+    kwargs = dict({'multi': 2, 'sleep': 1, 'timeout': 30, 'verbose': 0},
+        **options)
+    for i in range(2 if options.get('write_mode') == 'inc' else 1):
+        ret = qmmap.mmap(fn, "qmmap_src", "qmmap_dest", **kwargs)
+    wrong = [d for d in ret.find() if d['val'] != expected(d['_id'])]
+    if ret.count() != num or wrong:
+        print "FAILED %s: %d of %d documents, wrong values %s" % (name,
+            ret.count(), num, wrong[:5])
+        return False
+    print "ok     %s" % name
+    return True
+
+if __name__ == "__main__":
+    import pymongo
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    db = pymongo.MongoClient("mongodb://127.0.0.1/test").get_default_database()
+
+    if raw_input("drop qmmap_src, qmmap_dest, housekeeping(qmmap_src_qmmap_dest)?")[:1] == 'y':
+        db.qmmap_src.drop()
+        db.qmmap_dest.drop()
+        db.qmmap_src_qmmap_dest.drop()
+
+    for i in range(num):
+        db.qmmap_src.save({'_id': i, 'num': i})
+
+    failed = 0
+    for name, fn, options, expected in CASES:
+        if not run_case(db, name, fn, options, expected, num):
+            failed += 1
+    print "%d of %d cases failed" % (failed, len(CASES))
+    sys.exit(1 if failed else 0)